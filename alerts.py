@@ -0,0 +1,129 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Sends IBM Alert Notification alerts off the request path.  Alerts are pushed onto a bounded in-process queue and a
+# background worker posts them, coalescing repeats of the same (what, where, severity) seen within a time window into
+# a single alert with a count.  A full queue drops the alert and counts it rather than ever blocking a request.
+
+import datetime
+import json
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import requests
+
+ALERT_URL = 'https://ans-us-south.opsmgmt.bluemix.net/api/alerts/v1'
+
+class AlertDispatcher(object):
+    def __init__(self, username, password, url=ALERT_URL, window=30.0, max_queue=1000, retries=3, backoff=1.0, timeout=5.0):
+        self.username = username
+        self.password = password
+        self.url = url
+        self.window = window
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.counts = {'queued': 0, 'coalesced': 0, 'sent': 0, 'failed': 0, 'dropped': 0}
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._session = requests.Session()
+
+    @property
+    def enabled(self):
+        # sent only if the alert service is in use
+        return self.username != '' and self.password != ''
+
+    def send(self, details, where, severity):
+        # never blocks, the caller is usually a request handler which is already failing
+        if not self.enabled:
+            return
+        self._start()
+        try:
+            self._queue.put_nowait((str(details), where, severity, datetime.datetime.now()))
+            self._count('queued')
+        except queue.Full:
+            self._count('dropped')
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counts)
+        stats['pending'] = self._queue.qsize()
+        return stats
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='alert-dispatcher')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self.counts[key] += amount
+
+    def _run(self):
+        while True:
+            # block for the first alert, then gather everything else arriving within the window
+            batch = {}
+            self._add(batch, self._queue.get())
+            deadline = time.time() + self.window
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    self._add(batch, self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            for key, alert in batch.items():
+                self._post(key, alert)
+
+    def _add(self, batch, item):
+        what, where, severity, when = item
+        key = (what, where, severity)
+        if key in batch:
+            batch[key]['count'] += 1
+            batch[key]['last'] = when
+            self._count('coalesced')
+        else:
+            batch[key] = {'count': 1, 'first': when, 'last': when}
+
+    def _post(self, key, alert):
+        what, where, severity = key
+        message = {'What': what, 'Where': where, 'Severity': severity, 'When': str(alert['first'])}
+        if alert['count'] > 1:
+            message['Details'] = 'Occurred %d times between %s and %s' % (alert['count'], alert['first'], alert['last'])
+        # bounded retry with exponential backoff, then give up and count it
+        for attempt in range(self.retries + 1):
+            try:
+                response = self._session.post(self.url, auth=(self.username, self.password), timeout=self.timeout,
+                                              headers={"Content-Type": "application/json", "accept": "application/json"},
+                                              data=json.dumps(message))
+                if response.status_code < 400:
+                    self._count('sent')
+                    return
+                if response.status_code < 500:
+                    # a rejected alert will be rejected again
+                    break
+            except requests.RequestException:
+                pass
+            if attempt < self.retries:
+                time.sleep(self.backoff * (2 ** attempt))
+        self._count('failed')
@@ -0,0 +1,303 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Serves the JSON API on asyncio.  Classifying an item is almost entirely waiting on the NLC service and Kohls.com, so
+# here every request is a coroutine and every call goes through one pooled aiohttp session instead of holding a thread,
+# and a single process keeps hundreds of classifications in flight.  The cascade, routing, result cache, call guards,
+# page cache and response format are the ones welcome.py uses, so both servers answer identically.  The HTML pages
+# stay on the Flask app.
+#
+#   python async_app.py                                  needs aiohttp
+#   gunicorn -c gunicorn.conf.py 'async_app:make_app()' --worker-class aiohttp.GunicornWebWorker
+
+import asyncio
+import base64
+import json
+import os
+import time
+
+import aiohttp
+from aiohttp import web
+
+import metrics
+import welcome
+from call_guard import AsyncGuardedCaller, CircuitOpenError
+from kohls_fetcher import RETRY_STATUSES, product_id
+from result_cache import classifier_fingerprint
+
+# connections kept open by the shared session in total and to any one host, the NLC service and Kohls.com both draw on it
+ASYNC_CONNECTIONS = int(os.getenv('ASYNC_CONNECTIONS', '200'))
+ASYNC_CONNECTIONS_PER_HOST = int(os.getenv('ASYNC_CONNECTIONS_PER_HOST', '100'))
+
+# the same guards as the threaded app with a higher concurrency limit, a waiting call costs a coroutine rather than a
+# thread.  Reported in /metrics next to the threaded guards, under path="async"
+CLASSIFIER_CALLS = AsyncGuardedCaller(
+    max_concurrent=int(os.getenv('ASYNC_CLASSIFIER_MAX_CONCURRENT', str(ASYNC_CONNECTIONS_PER_HOST))),
+    queue_timeout=welcome.CLASSIFIER_CALLS.queue_timeout,
+    failure_threshold=welcome.CLASSIFIER_CALLS.failure_threshold,
+    reset_seconds=welcome.CLASSIFIER_CALLS.reset_seconds)
+welcome.METRICS.add_collector(welcome.guard_collector(CLASSIFIER_CALLS, 'async'))
+
+# largest request body accepted
+ASYNC_MAX_BODY = int(os.getenv('ASYNC_MAX_BODY', str(10 * 1024 * 1024)))
+
+ENDPOINTS = {'/api/v1/classify': 'api_classify', '/api/v1/classify_url': 'api_classify_url'}
+
+SESSION = web.AppKey('session', aiohttp.ClientSession)
+CLASSIFIER_CLIENT = web.AppKey('classifier_client', object)
+PAGES = web.AppKey('pages', object)
+
+class AsyncNLCClient(object):
+    # the REST call behind NaturalLanguageClassifierV1.classify, made on the shared session
+    def __init__(self, session, url, username, password, timeout):
+        self.session = session
+        self.url = url.rstrip('/')
+        self.headers = {'Authorization': 'Basic ' + base64.b64encode(('%s:%s' % (username, password)).encode('utf-8')).decode('ascii')}
+        self.timeout = aiohttp.ClientTimeout(sock_connect=3.05, sock_read=timeout)
+
+    async def classify(self, classifier_id, text):
+        async with self.session.post('%s/v1/classifiers/%s/classify' % (self.url, classifier_id), json={'text': text},
+                                     headers=self.headers, timeout=self.timeout) as response:
+            response.raise_for_status()
+            return await response.json()
+
+class ExecutorClassifierClient(object):
+    # an in-process backend such as the local classifier, called on the default thread pool off the event loop
+    def __init__(self, service):
+        self.service = service
+
+    async def classify(self, classifier_id, text):
+        return await asyncio.get_running_loop().run_in_executor(None, self.service.classify, classifier_id, text)
+
+class AsyncPageFetcher(object):
+    # Kohl's product pages on the shared session, with the page cache, retries and counters of welcome.PAGE_FETCHER
+    def __init__(self, fetcher, session):
+        self.fetcher = fetcher
+        self.session = session
+        connect_timeout, read_timeout = fetcher.timeout
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+
+    async def fetch(self, url):
+        prd_id = product_id(url)
+        if prd_id is None:
+            return None
+        cached, headers = self.fetcher.revalidation(prd_id)
+        started = time.time()
+        status, content, response_headers = await self._get(self.fetcher.page_url(url), headers)
+        fetch_seconds = time.time() - started
+        # parsing the page is CPU bound, keep it off the event loop
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.fetcher.complete, prd_id, cached, status, content, response_headers, fetch_seconds)
+
+    async def _get(self, url, headers):
+        # bounded retry with exponential backoff on connection errors and retryable statuses, as KohlsPageFetcher._get
+        attempt = 0
+        while True:
+            try:
+                async with self.session.get(url, headers=headers, timeout=self.timeout) as response:
+                    if response.status not in RETRY_STATUSES:
+                        if response.status != 304:
+                            response.raise_for_status()
+                        return response.status, await response.read(), response.headers
+                    error = aiohttp.ClientResponseError(response.request_info, response.history, status=response.status,
+                                                        message='%s returned %s' % (url, response.status))
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as details:
+                error = details
+            if attempt >= self.fetcher.retries:
+                self.fetcher.count('failures')
+                raise error
+            self.fetcher.count('retries')
+            await asyncio.sleep(self.fetcher.backoff * (2 ** attempt))
+            attempt += 1
+
+async def call_classifier(client, all_classifiers, name, input_text):
+    # guarded, timed and counted per classifier name like welcome._call_classifier
+    classifier_id = all_classifiers[name]['id']
+    async def call():
+        metrics.count_remote_call()
+        try:
+            with metrics.timed(welcome.CLASSIFIER_SECONDS, record_as='nlc_' + name, classifier=name):
+                return await client.classify(classifier_id, input_text)
+        except Exception:
+            welcome.CLASSIFIER_ERRORS.inc(classifier=name)
+            raise
+    return await CLASSIFIER_CALLS.call(name, (classifier_id, input_text), call)
+
+async def run_cascade(client, all_classifiers, input_text):
+    # the top level call, then every second level classifier of the routed branches at once
+    classifier_output_0 = welcome._top_two(await call_classifier(client, all_classifiers, 'Product_description_Top_Level', input_text))
+    candidates = welcome.ROUTER.route(classifier_output_0)
+    called = welcome._branch_classifiers(candidates)
+    responses = await asyncio.gather(*[call_classifier(client, all_classifiers, name, input_text) for name in called],
+                                     return_exceptions=True)
+    outputs = {}
+    complete = True
+    for name, response in zip(called, responses):
+        if isinstance(response, CircuitOpenError):
+            # fall back to the top level rather than failing the whole classification
+            welcome.CASCADE_FALLBACKS.inc(classifier=name)
+            complete = False
+        elif isinstance(response, BaseException):
+            raise response
+        else:
+            outputs[name] = welcome._top_two(response)
+    return welcome._assemble(classifier_output_0, candidates, outputs), complete
+
+async def classify(client, input_text):
+    # same snapshot, cache key and caching rule as welcome._classify
+    all_classifiers = welcome.REGISTRY.classifiers
+    fingerprint = classifier_fingerprint(all_classifiers) + '|' + welcome.ROUTER.fingerprint
+    with welcome._timed_stage('classify'):
+        full_output = await _cache_call(welcome.RESULT_CACHE.get, input_text, fingerprint)
+        if full_output is None:
+            full_output, complete = await run_cascade(client, all_classifiers, input_text)
+            if complete:
+                await _cache_call(welcome.RESULT_CACHE.put, input_text, fingerprint, full_output)
+    return full_output
+
+async def _cache_call(method, *args):
+    # the SQLite tier reads and commits on the default thread pool, a memory-only cache is cheap enough to call inline
+    if not welcome.RESULT_CACHE.path:
+        return method(*args)
+    return await asyncio.get_running_loop().run_in_executor(None, method, *args)
+
+async def classify_text(app, item):
+    text = item.get('text')
+    if not isinstance(text, str) or not text.strip():
+        return welcome._api_error(item, 'No text to classify')
+    try:
+        return welcome._api_format(item, await classify(app[CLASSIFIER_CLIENT], text))
+    except Exception as details:
+        welcome._error_alerts(details, 'api_classify', 'Fatal')
+        return welcome._api_error(item, 'Unexpected error encountered')
+
+async def classify_url(app, item):
+    url = item.get('url')
+    input_text = False
+    try:
+        page = await app[PAGES].fetch(url) if isinstance(url, str) else None
+        if page is not None:
+            input_text = welcome._page_description(page)
+    except Exception as details:
+        welcome._error_alerts(details, 'get_url_text', 'Fatal')
+    if not input_text:
+        return welcome._api_error(item, 'Invalid Url.  Please provide a product page from Kohls.com.')
+    try:
+        result = welcome._api_format(item, await classify(app[CLASSIFIER_CLIENT], input_text))
+    except Exception as details:
+        welcome._error_alerts(details, 'api_classify_url', 'Fatal')
+        return welcome._api_error(item, 'Unexpected error encountered')
+    result['url'] = url
+    result['text'] = input_text
+    return result
+
+async def api_classify(request):
+    return await _api_handler(request, 'text', classify_text)
+
+async def api_classify_url(request):
+    return await _api_handler(request, 'url', classify_url)
+
+async def _api_handler(request, field, classify_item):
+    # the payload rules of welcome._api_handler: a single item or an array of items, bare strings or objects
+    if not welcome.REGISTRY.ready:
+        return json_response(request, {'error': 'Classifier is currently %s.' % (welcome.REGISTRY.status)}, 503)
+    payload = None
+    # a JSON content type is required, as for Flask's get_json
+    if request.content_type == 'application/json' or request.content_type.endswith('+json'):
+        try:
+            payload = json.loads(await request.read())
+        except ValueError:
+            pass
+    if payload is None:
+        return json_response(request, {'error': 'Expected a JSON body'}, 400)
+    single = not isinstance(payload, list)
+    items = [payload] if single else payload
+    if len(items) > welcome.API_MAX_ITEMS:
+        return json_response(request, {'error': 'At most %d items per request' % (welcome.API_MAX_ITEMS)}, 400)
+    items = [item if isinstance(item, dict) else {field: item} for item in items]
+    # independent items are classified concurrently, results keep the request order
+    results = await asyncio.gather(*[classify_item(request.app, item) for item in items])
+    if single:
+        return json_response(request, results[0], 200 if 'error' not in results[0] else 422)
+    return json_response(request, {'results': results})
+
+def json_response(request, body, status=200):
+    # compact JSON, gzipped when the client accepts it and it is big enough to be worth it, as welcome._json_response
+    data = json.dumps(body, separators=(',', ':')).encode('utf-8')
+    response = web.Response(body=data, status=status, content_type='application/json')
+    response.headers['Vary'] = 'Accept-Encoding'
+    if len(data) >= welcome.GZIP_MIN_BYTES and 'gzip' in request.headers.get('Accept-Encoding', ''):
+        response.enable_compression(web.ContentCoding.gzip)
+    return response
+
+async def healthz(request):
+    return json_response(request, welcome._health())
+
+async def readyz(request):
+    return json_response(request, *welcome._readiness())
+
+async def metrics_endpoint(request):
+    return web.Response(text=welcome.METRICS.render(), headers={'Content-Type': 'text/plain; version=0.0.4'})
+
+@web.middleware
+async def instrumented(request, handler):
+    # in-flight gauge, total latency, remote call count and the opt-in Server-Timing header, as welcome._instrumented.
+    # Each request is its own task, so its metrics context is its own too
+    endpoint = ENDPOINTS.get(request.path)
+    if endpoint is None:
+        return await handler(request)
+    welcome.REQUESTS_IN_FLIGHT.inc(endpoint=endpoint)
+    record = metrics.start_request()
+    status = 500
+    try:
+        with welcome._timed_stage(endpoint):
+            response = await handler(request)
+        status = response.status
+        if request.headers.get(welcome.TIMING_HEADER):
+            response.headers['Server-Timing'] = metrics.server_timing(record)
+        return response
+    except web.HTTPException as details:
+        status = details.status
+        raise
+    finally:
+        welcome.REMOTE_CALLS.observe(record['remote_calls'], endpoint=endpoint)
+        welcome.REQUESTS_TOTAL.inc(endpoint=endpoint, status=status)
+        welcome.REQUESTS_IN_FLIGHT.dec(endpoint=endpoint)
+        metrics.end_request()
+
+async def _start(app):
+    # begin discovering/training classifiers, or follow the registry store, before the first request
+    welcome.REGISTRY.start()
+    session = app[SESSION] = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=ASYNC_CONNECTIONS, limit_per_host=ASYNC_CONNECTIONS_PER_HOST))
+    app[PAGES] = AsyncPageFetcher(welcome.PAGE_FETCHER, session)
+    if welcome.NLC_BACKEND == 'local':
+        app[CLASSIFIER_CLIENT] = ExecutorClassifierClient(welcome.REGISTRY.service)
+    else:
+        app[CLASSIFIER_CLIENT] = AsyncNLCClient(session, welcome.NLC_URL, welcome.NLC_USERNAME, welcome.NLC_PASSWORD, welcome.NLC_TIMEOUT)
+
+async def _stop(app):
+    await app[SESSION].close()
+
+def make_app():
+    # room for API_MAX_ITEMS long descriptions
+    app = web.Application(middlewares=[instrumented], client_max_size=ASYNC_MAX_BODY)
+    app.router.add_post('/api/v1/classify', api_classify)
+    app.router.add_post('/api/v1/classify_url', api_classify_url)
+    app.router.add_get('/healthz', healthz)
+    app.router.add_get('/readyz', readyz)
+    app.router.add_get('/metrics', metrics_endpoint)
+    app.on_startup.append(_start)
+    app.on_cleanup.append(_stop)
+    return app
+
+if __name__ == '__main__':
+    web.run_app(make_app(), port=int(welcome.port))
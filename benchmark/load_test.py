@@ -0,0 +1,174 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Replays product descriptions against /classify_text and /classify_url at a fixed concurrency and reports latency
+# percentiles, throughput and remote calls per request.  Descriptions come from requests.jsonl and rows sampled from
+# the data/*.csv files; url requests use product pages served by benchmark/stub_nlc.py.  The workload is seeded, so
+# two runs against different builds replay exactly the same requests.
+#
+#   python benchmark/load_test.py --app http://localhost:5000 --stub http://localhost:8020 --requests 2000 --concurrency 32
+
+import argparse
+import csv
+import io
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+# the classification results table, see ResultsTable in welcome.py
+RESULTS_TABLE = b'id="classes"'
+
+def load_workload(jsonl_path, data_folder, samples, url_fraction, seed):
+    rng = random.Random(seed)
+    texts = []
+    # backlog style records, title and body make up the description
+    if jsonl_path and os.path.exists(jsonl_path):
+        with io.open(jsonl_path, encoding='utf-8') as records:
+            for line in records:
+                if line.strip():
+                    record = json.loads(line)
+                    texts.append(' '.join(record.get(key, '') for key in ['title', 'body', 'text', 'description']).strip())
+    # rows sampled from each training data file
+    for name in sorted(os.listdir(data_folder)):
+        if name.endswith('.csv'):
+            with io.open(os.path.join(data_folder, name), encoding='utf-8', errors='replace') as training_data:
+                rows = [row[0] for row in csv.reader(training_data) if row]
+            texts.extend(rng.sample(rows, min(samples, len(rows))))
+    texts = [text for text in texts if text]
+
+    workload = []
+    for text in texts:
+        if rng.random() < url_fraction:
+            # the stub serves product prd-N as the Nth description of its data folder
+            workload.append(('/classify_url', {'classifierinput_url': 'https://www.kohls.com/product/prd-%d/item.jsp' % rng.randrange(100000)}))
+        else:
+            workload.append(('/classify_text', {'classifierinput_text': text}))
+    rng.shuffle(workload)
+    return workload
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+def run(app_url, workload, total, concurrency, timeout):
+    results = []
+    lock = threading.Lock()
+    local = threading.local()
+    counter = iter(range(total))
+
+    def worker():
+        # one pooled session per worker thread
+        local.session = getattr(local, 'session', None) or requests.Session()
+        while True:
+            with lock:
+                index = next(counter, None)
+            if index is None:
+                return
+            path, form = workload[index % len(workload)]
+            started = time.time()
+            try:
+                response = local.session.post(app_url.rstrip('/') + path, data=form, timeout=timeout)
+                # only a rendered results table counts, the page also answers 200 while the classifiers are training,
+                # unavailable or the url is rejected
+                ok = response.status_code == 200 and RESULTS_TABLE in response.content
+            except requests.RequestException:
+                ok = False
+            elapsed = time.time() - started
+            with lock:
+                results.append((path, elapsed, ok))
+
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(worker) for _ in range(concurrency)]:
+            future.result()
+    return results, time.time() - started
+
+def stub_stats(stub_url):
+    if not stub_url:
+        return None
+    return requests.get(stub_url.rstrip('/') + '/_stats', timeout=10).json()
+
+def report(results, wall_seconds, stats_before, stats_after):
+    summary = {'requests': len(results), 'errors': sum(1 for _, _, ok in results if not ok),
+               'wall_seconds': wall_seconds, 'requests_per_second': len(results) / wall_seconds if wall_seconds else 0.0,
+               'endpoints': {}}
+    for path in sorted(set(path for path, _, _ in results)):
+        latencies = [elapsed for p, elapsed, _ in results if p == path]
+        summary['endpoints'][path] = {'requests': len(latencies),
+                                      'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95),
+                                      'p99': percentile(latencies, 99), 'max': max(latencies)}
+    latencies = [elapsed for _, elapsed, _ in results]
+    summary.update(p50=percentile(latencies, 50), p95=percentile(latencies, 95), p99=percentile(latencies, 99))
+    if stats_before is not None and stats_after is not None and results:
+        # remote calls as seen by the stub, includes anything the app's caches saved
+        delta = dict((key, stats_after[key] - stats_before.get(key, 0)) for key in stats_after)
+        summary['remote_calls'] = delta
+        summary['nlc_calls_per_request'] = delta.get('classify', 0) / float(len(results))
+        summary['page_fetches_per_request'] = delta.get('page', 0) / float(len(results))
+    return summary
+
+def print_report(summary):
+    print('requests %d  errors %d  wall %.1fs  %.1f req/s' % (summary['requests'], summary['errors'], summary['wall_seconds'], summary['requests_per_second']))
+    print('%-16s %8s %9s %9s %9s %9s' % ('endpoint', 'requests', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+    for path, data in sorted(summary['endpoints'].items()):
+        print('%-16s %8d %9.1f %9.1f %9.1f %9.1f' % (path, data['requests'], data['p50'] * 1000, data['p95'] * 1000, data['p99'] * 1000, data['max'] * 1000))
+    print('%-16s %8d %9.1f %9.1f %9.1f' % ('all', summary['requests'], summary['p50'] * 1000, summary['p95'] * 1000, summary['p99'] * 1000))
+    if 'nlc_calls_per_request' in summary:
+        print('NLC calls/request %.2f  page fetches/request %.2f' % (summary['nlc_calls_per_request'], summary['page_fetches_per_request']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay product descriptions against the classifier app and report latency')
+    parser.add_argument('--app', default='http://localhost:5000', help='base url of the app under test')
+    parser.add_argument('--stub', default=None, help='base url of benchmark/stub_nlc.py, enables remote call counts')
+    parser.add_argument('--jsonl', default=os.path.join(ROOT, 'requests.jsonl'), help='JSONL records to replay')
+    parser.add_argument('--data', default=os.path.join(ROOT, 'data'), help='folder of training CSVs to sample from')
+    parser.add_argument('--samples', type=int, default=200, help='rows sampled from each CSV')
+    parser.add_argument('--url-fraction', type=float, default=0.0, help='fraction of requests sent to /classify_url')
+    parser.add_argument('--requests', type=int, default=1000, help='total requests to send')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--warmup', type=int, default=0, help='requests sent and discarded before measuring')
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', default=None, help='also write the report to this file')
+    parser.add_argument('--max-p95', type=float, default=None, help='exit non-zero if overall p95 exceeds this many seconds')
+    parser.add_argument('--max-error-rate', type=float, default=None, help='exit non-zero if the error rate exceeds this fraction')
+    args = parser.parse_args()
+
+    workload = load_workload(args.jsonl, args.data, args.samples, args.url_fraction, args.seed)
+    if args.warmup:
+        run(args.app, workload, args.warmup, args.concurrency, args.timeout)
+    before = stub_stats(args.stub)
+    results, wall_seconds = run(args.app, workload, args.requests, args.concurrency, args.timeout)
+    summary = report(results, wall_seconds, before, stub_stats(args.stub))
+    print_report(summary)
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(summary, output, indent=2, sort_keys=True)
+
+    # regression gates for CI
+    failed = False
+    if args.max_p95 is not None and summary['p95'] > args.max_p95:
+        print('p95 %.3fs exceeds the %.3fs limit' % (summary['p95'], args.max_p95))
+        failed = True
+    if args.max_error_rate is not None and summary['errors'] > args.max_error_rate * summary['requests']:
+        print('error rate %.3f exceeds the %.3f limit' % (summary['errors'] / float(summary['requests']), args.max_error_rate))
+        failed = True
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,174 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Local stand in for the Watson NLC REST API and for Kohl's product pages, so the app can be load tested without
+# touching either.  It implements the list_classifiers / get_classifier / create_classifier / classify calls the app
+# makes, with configurable latency and error injection.  Classifications are deterministic for a given text and are
+# drawn from the classes in the uploaded training data, so the app's cascade routes just as it would for real.
+#
+#   python benchmark/stub_nlc.py --port 8020 --latency 0.15 --jitter 0.05 --error-rate 0.01
+#   NLC_URL=http://localhost:8020 NLC_USERNAME=stub NLC_PASSWORD=stub KOHLS_BASE_URL=http://localhost:8020 python welcome.py
+
+import argparse
+import csv
+import hashlib
+import io
+import json
+import os
+import random
+import threading
+import time
+import uuid
+
+from flask import Flask, Response, request
+
+app = Flask(__name__)
+
+CONFIG = {'latency': 0.0, 'jitter': 0.0, 'error_rate': 0.0, 'page_latency': 0.0, 'train_seconds': 0.0}
+CLASSIFIERS = {}
+# descriptions served as Kohl's product pages, prd-N gets the Nth one
+PAGES = []
+STATS = {'list_classifiers': 0, 'get_classifier': 0, 'create_classifier': 0, 'classify': 0, 'page': 0, 'errors': 0}
+LOCK = threading.Lock()
+
+PAGE_TEMPLATE = '<html><body><div id="%s_productDetails"><div><p>PRODUCT FEATURES</p><p>%s</p></div></div></body></html>'
+
+def _simulate(latency):
+    # count the call, sleep for the configured latency and inject failures
+    if latency:
+        time.sleep(max(0.0, random.gauss(latency, CONFIG['jitter'])))
+    if random.random() < CONFIG['error_rate']:
+        with LOCK:
+            STATS['errors'] += 1
+        return Response(json.dumps({'code': 500, 'error': 'Injected failure'}), status=500, mimetype='application/json')
+    return None
+
+def _count(call):
+    with LOCK:
+        STATS[call] += 1
+
+def _describe(data):
+    # training finishes train_seconds after the classifier was created
+    status = 'Available' if time.time() - data['created'] >= CONFIG['train_seconds'] else 'Training'
+    return {'classifier_id': data['classifier_id'], 'name': data['name'], 'language': 'en', 'status': status,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(data['created'])) + '.%03dZ' % (data['created'] % 1 * 1000),
+            'url': request.host_url + 'v1/classifiers/' + data['classifier_id']}
+
+def _part(name):
+    # the SDK sends parts without a filename as plain form fields
+    if name in request.files:
+        return request.files[name].read().decode('utf-8', 'replace')
+    return request.form[name]
+
+def _json(body, status=200):
+    return Response(json.dumps(body), status=status, mimetype='application/json')
+
+@app.route('/v1/classifiers', methods=['GET'])
+def list_classifiers():
+    _count('list_classifiers')
+    failure = _simulate(CONFIG['latency'])
+    if failure is not None:
+        return failure
+    return _json({'classifiers': [_describe(data) for data in list(CLASSIFIERS.values())]})
+
+@app.route('/v1/classifiers/<classifier_id>', methods=['GET'])
+def get_classifier(classifier_id):
+    _count('get_classifier')
+    failure = _simulate(CONFIG['latency'])
+    if failure is not None:
+        return failure
+    if classifier_id not in CLASSIFIERS:
+        return _json({'code': 404, 'error': 'Not found'}, 404)
+    return _json(_describe(CLASSIFIERS[classifier_id]))
+
+@app.route('/v1/classifiers', methods=['POST'])
+def create_classifier():
+    _count('create_classifier')
+    metadata = json.loads(_part('training_metadata'))
+    raw = _part('training_data')
+    classes = sorted(set(row[1] for row in csv.reader(io.StringIO(raw)) if len(row) >= 2))
+    if len(classes) < 2:
+        return _json({'code': 400, 'error': 'Training data needs at least two classes'}, 400)
+    data = {'classifier_id': uuid.uuid4().hex[:10] + '-nlc-stub', 'name': metadata.get('name'), 'classes': classes, 'created': time.time()}
+    CLASSIFIERS[data['classifier_id']] = data
+    return _json(_describe(data))
+
+@app.route('/v1/classifiers/<classifier_id>', methods=['DELETE'])
+def delete_classifier(classifier_id):
+    CLASSIFIERS.pop(classifier_id, None)
+    return _json({})
+
+@app.route('/v1/classifiers/<classifier_id>/classify', methods=['POST'])
+def classify(classifier_id):
+    _count('classify')
+    failure = _simulate(CONFIG['latency'])
+    if failure is not None:
+        return failure
+    if classifier_id not in CLASSIFIERS:
+        return _json({'code': 404, 'error': 'Not found'}, 404)
+    text = request.get_json()['text']
+    classes = CLASSIFIERS[classifier_id]['classes']
+    # deterministic per text and classifier, so repeated runs route identically
+    seed = int(hashlib.md5((classifier_id + text).encode('utf-8')).hexdigest(), 16)
+    ranked = random.Random(seed).sample(classes, min(len(classes), 10))
+    weights = [1.0 / (rank + 1) ** 2 for rank in range(len(ranked))]
+    total = sum(weights)
+    return _json({'classifier_id': classifier_id, 'text': text, 'top_class': ranked[0],
+                  'classes': [{'class_name': name, 'confidence': weight / total} for name, weight in zip(ranked, weights)]})
+
+@app.route('/product/prd-<prd_id>/<path:rest>')
+def product_page(prd_id, rest):
+    _count('page')
+    failure = _simulate(CONFIG['page_latency'])
+    if failure is not None:
+        return failure
+    if not prd_id.isdigit() or not PAGES:
+        return Response('Not found', status=404)
+    description = PAGES[int(prd_id) % len(PAGES)]
+    return Response(PAGE_TEMPLATE % (prd_id, description.replace('<', '&lt;')), mimetype='text/html')
+
+@app.route('/_stats', methods=['GET'])
+def stats():
+    with LOCK:
+        return _json(dict(STATS))
+
+@app.route('/_reset', methods=['POST'])
+def reset():
+    with LOCK:
+        for key in STATS:
+            STATS[key] = 0
+    return _json({})
+
+def load_pages(data_folder):
+    # every description in the training data, in a stable order
+    pages = []
+    for name in sorted(os.listdir(data_folder)):
+        if name.endswith('.csv'):
+            with io.open(os.path.join(data_folder, name), encoding='utf-8', errors='replace') as training_data:
+                pages.extend(row[0] for row in csv.reader(training_data) if row)
+    return pages
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand in for the Watson NLC API and Kohls.com product pages')
+    parser.add_argument('--port', type=int, default=8020)
+    parser.add_argument('--latency', type=float, default=0.0, help='mean seconds added to every NLC call')
+    parser.add_argument('--jitter', type=float, default=0.0, help='standard deviation of the added latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of calls which fail with a 500')
+    parser.add_argument('--page-latency', type=float, default=0.0, help='mean seconds added to every product page')
+    parser.add_argument('--train-seconds', type=float, default=0.0, help='how long new classifiers report Training')
+    parser.add_argument('--data', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'data'),
+                        help='folder of CSVs used as product page descriptions')
+    args = parser.parse_args()
+    CONFIG.update(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                  page_latency=args.page_latency, train_seconds=args.train_seconds)
+    PAGES.extend(load_pages(args.data))
+    app.run(host='0.0.0.0', port=args.port, threaded=True)
@@ -0,0 +1,231 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Guards the calls made to each classifier.  Identical calls already in flight are shared rather than repeated, each
+# classifier has a bounded number of concurrent calls with a bounded wait for a slot, and a circuit breaker per
+# classifier fails fast once it keeps failing, letting a single trial call through after a cool down.  Timeouts on the
+# calls themselves are set on the HTTP client, see _nlc_backend in welcome.py.  AsyncGuardedCaller applies the same
+# guards to coroutines for the asyncio serving path.
+
+import asyncio
+import threading
+import time
+from concurrent.futures import Future
+
+class CircuitOpenError(Exception):
+    # the classifier failed repeatedly and is not being called until its cool down has passed
+    pass
+
+class CallRejectedError(Exception):
+    # every call slot for the classifier stayed busy for longer than the caller is willing to wait
+    pass
+
+class CircuitBreaker(object):
+    def __init__(self, failure_threshold=5, reset_seconds=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = 'closed'
+        self.failures = 0
+        self.opened = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.time() - self.opened >= self.reset_seconds:
+                # cooled down, let one trial call decide whether to close again
+                self.state = 'half_open'
+            if self.state == 'half_open' and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+            self._trial = False
+
+    def abandon(self):
+        # a trial call which never ran proves nothing either way, the next caller gets to try
+        with self._lock:
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                self.state = 'open'
+                self.opened = time.time()
+
+class SingleFlight(object):
+    # the first caller for a key makes the call, everyone arriving while it runs gets the same result or exception
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        # returns (result, shared)
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        if not leader:
+            return future.result(), True
+        try:
+            result = fn()
+            future.set_result(result)
+            return result, False
+        except BaseException as details:
+            future.set_exception(details)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+class GuardedCaller(object):
+    def __init__(self, max_concurrent=8, queue_timeout=5.0, failure_threshold=5, reset_seconds=30.0):
+        self.max_concurrent = max_concurrent
+        self.queue_timeout = queue_timeout
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.counts = {'calls': 0, 'shared': 0, 'rejected': 0, 'short_circuited': 0, 'failures': 0}
+        self._flight = SingleFlight()
+        self._breakers = {}
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def call(self, name, key, fn):
+        # fn makes the call to classifier name, key identifies identical calls (classifier id and text)
+        result, shared = self._flight.do(key, lambda: self._guarded(name, fn))
+        if shared:
+            self._count('shared')
+        return result
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counts)
+            stats['breakers'] = dict((name, breaker.state) for name, breaker in self._breakers.items())
+        return stats
+
+    def _guarded(self, name, fn):
+        breaker, semaphore = self._guards(name)
+        if not breaker.allow():
+            self._count('short_circuited')
+            raise CircuitOpenError('%s is failing, not called for up to %ds' % (name, self.reset_seconds))
+        if not semaphore.acquire(timeout=self.queue_timeout):
+            breaker.abandon()
+            self._count('rejected')
+            raise CallRejectedError('%s has %d calls in flight already' % (name, self.max_concurrent))
+        self._count('calls')
+        try:
+            result = fn()
+        except Exception:
+            breaker.failure()
+            self._count('failures')
+            raise
+        finally:
+            semaphore.release()
+        breaker.success()
+        return result
+
+    def _guards(self, name):
+        with self._lock:
+            if name not in self._breakers:
+                self._breakers[name] = CircuitBreaker(self.failure_threshold, self.reset_seconds)
+                self._semaphores[name] = self._semaphore()
+            return self._breakers[name], self._semaphores[name]
+
+    def _semaphore(self):
+        return threading.BoundedSemaphore(self.max_concurrent)
+
+    def _count(self, key):
+        with self._lock:
+            self.counts[key] += 1
+
+class AsyncGuardedCaller(GuardedCaller):
+    # the same guards for coroutines, every call is made from one event loop
+    def __init__(self, *args, **kwargs):
+        super(AsyncGuardedCaller, self).__init__(*args, **kwargs)
+        self._in_flight = {}
+
+    async def call(self, name, key, fn):
+        # fn is a coroutine function making the call to classifier name
+        while key in self._in_flight:
+            future = self._in_flight[key]
+            try:
+                # a caller giving up must not cancel the call for everyone else
+                result = await asyncio.shield(future)
+                self._count('shared')
+                return result
+            except asyncio.CancelledError:
+                if not future.cancelled() or self._cancelling():
+                    raise
+                # the leader gave up rather than this caller, so make the call again, as the new leader if nobody
+                # else got there first
+        future = self._in_flight[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await self._guarded(name, fn)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as details:
+            future.set_exception(details)
+            # retrieved here so an exception nobody else waited for is not logged as unhandled
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._in_flight[key]
+
+    async def _guarded(self, name, fn):
+        breaker, semaphore = self._guards(name)
+        if not breaker.allow():
+            self._count('short_circuited')
+            raise CircuitOpenError('%s is failing, not called for up to %ds' % (name, self.reset_seconds))
+        try:
+            await asyncio.wait_for(semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            breaker.abandon()
+            self._count('rejected')
+            raise CallRejectedError('%s has %d calls in flight already' % (name, self.max_concurrent))
+        except asyncio.CancelledError:
+            breaker.abandon()
+            raise
+        self._count('calls')
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            breaker.abandon()
+            raise
+        except Exception:
+            breaker.failure()
+            self._count('failures')
+            raise
+        finally:
+            semaphore.release()
+        breaker.success()
+        return result
+
+    def _semaphore(self):
+        return asyncio.Semaphore(self.max_concurrent)
+
+    def _cancelling(self):
+        # whether this caller's own task is being cancelled, only known from Python 3.11
+        task = asyncio.current_task()
+        return bool(getattr(task, 'cancelling', lambda: 0)())
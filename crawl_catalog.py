@@ -0,0 +1,278 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Classifies a whole catalog of Kohl's products from the command line.  Product pages are fetched concurrently under a
+# per-host rate limit and their descriptions classified on a separate bounded pool, both through the same code the app
+# uses.  Every finished product is appended to a checkpoint file, so a restarted run skips what is already done and
+# rebuilds its output from the checkpoint instead of fetching and classifying it again.
+#
+#   python crawl_catalog.py products.txt --output catalog.csv          one product id or url per line
+#   python crawl_catalog.py products.txt --output catalog.parquet      needs pyarrow
+
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+# Parquet output is optional, CSV needs nothing extra
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+import welcome
+from kohls_fetcher import product_id
+
+PRODUCT_URL = 'https://www.kohls.com/product/prd-%s/product.jsp'
+COLUMNS = ['product_id', 'url', 'path', 'results', 'description', 'error']
+# rows buffered per Parquet row group
+PARQUET_BATCH = 1000
+
+class RateLimiter(object):
+    # token bucket per host: up to burst requests at once, then rate requests per second
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, host):
+        while True:
+            with self._lock:
+                now = time.time()
+                tokens, updated = self._buckets.get(host, (self.burst, now))
+                tokens = min(self.burst, tokens + (now - updated) * self.rate)
+                if tokens >= 1:
+                    self._buckets[host] = (tokens - 1, now)
+                    return
+                self._buckets[host] = (tokens, now)
+                delay = (1 - tokens) / self.rate
+            time.sleep(delay)
+
+def read_products(lines):
+    # (product id, url) for every line, in order and without repeats.  A bare id or prd-id becomes a product url
+    seen = set()
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.isdigit() or (line.startswith('prd-') and line[4:].isdigit()):
+            url = PRODUCT_URL % (line.replace('prd-', ''))
+        else:
+            url = line
+        prd_id = product_id(url) or url
+        if prd_id not in seen:
+            seen.add(prd_id)
+            yield prd_id, url
+
+def load_checkpoint(path):
+    # finished rows by product id, a later line for the same product replaces an earlier one.  A line cut short by a
+    # crash is cut off the file, so new rows are not appended to it, and that product is simply done again
+    done = {}
+    if os.path.exists(path):
+        with open(path, 'rb+') as checkpoint:
+            complete = 0
+            for line in checkpoint:
+                if not line.endswith(b'\n'):
+                    break
+                complete += len(line)
+                try:
+                    row = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    continue
+                done[row['product_id']] = row
+            checkpoint.truncate(complete)
+    return done
+
+class CsvOutput(object):
+    def __init__(self, path):
+        self._file = io.open(path, 'w', encoding='utf-8', newline='')
+        self._writer = csv.DictWriter(self._file, COLUMNS)
+        self._writer.writeheader()
+
+    def write(self, row):
+        self._writer.writerow(row)
+
+    def close(self):
+        self._file.close()
+
+class ParquetOutput(object):
+    # written under a temporary name, a Parquet file is only readable once its footer has been written on close
+    def __init__(self, path):
+        self.path = path
+        self._schema = pyarrow.schema([(column, pyarrow.string()) for column in COLUMNS])
+        self._writer = pyarrow.parquet.ParquetWriter(path + '.tmp', self._schema)
+        self._rows = []
+
+    def write(self, row):
+        self._rows.append(row)
+        if len(self._rows) >= PARQUET_BATCH:
+            self._flush()
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+        os.replace(self.path + '.tmp', self.path)
+
+    def _flush(self):
+        if self._rows:
+            self._writer.write_table(pyarrow.Table.from_pylist(self._rows, schema=self._schema))
+            self._rows = []
+
+def _fetch(limiter, prd_id, url):
+    # rate limited against the host actually contacted, which is the stand in when KOHLS_BASE_URL is set
+    limiter.acquire(urlparse(welcome.PAGE_FETCHER.base_url or url).netloc)
+    description = welcome._get_Kohls_url_info(url)
+    if description is False:
+        raise ValueError('Not a Kohls.com product page')
+    if not description:
+        raise ValueError('No product description found')
+    return description
+
+def _classify(description):
+    full_output = welcome._classify(description)
+    return '-'.join([welcome._capitalize(i['class_1']) for i in full_output]), json.dumps(full_output)
+
+def _row(prd_id, url, description='', path='', results='', error=''):
+    return {'product_id': prd_id, 'url': url, 'path': path, 'results': results, 'description': description, 'error': error}
+
+class Progress(object):
+    def __init__(self, total, resumed, every):
+        self.total = total
+        self.resumed = resumed
+        self.every = every
+        self.done = 0
+        self.fetch_errors = 0
+        self.classify_errors = 0
+        self.started = time.time()
+        self._reported = self.started
+
+    def count(self, failed_stage=None):
+        self.done += 1
+        if failed_stage == 'fetch':
+            self.fetch_errors += 1
+        elif failed_stage == 'classify':
+            self.classify_errors += 1
+        if time.time() - self._reported >= self.every:
+            self.report()
+
+    def report(self, final=False):
+        self._reported = time.time()
+        elapsed = self._reported - self.started
+        rate = self.done / elapsed if elapsed else 0.0
+        remaining = self.total - self.resumed - self.done
+        line = '%s %d/%d (%d resumed)  %.1f products/s  fetch errors %d  classify errors %d' % (
+            'done' if final else 'progress', self.resumed + self.done, self.total, self.resumed, rate, self.fetch_errors, self.classify_errors)
+        if not final and rate:
+            line += '  about %ds left' % (remaining / rate)
+        sys.stderr.write(line + '\n')
+        sys.stderr.flush()
+
+def wait_until_ready(poll=5.0):
+    # this process discovers the classifiers itself, or follows a running server's registry store
+    welcome.REGISTRY.start()
+    while not welcome.REGISTRY.ready:
+        status = welcome.REGISTRY.status
+        if status in ['unconfigured', 'unavailable']:
+            raise SystemExit('Classifiers are %s, nothing to classify with' % (status))
+        sys.stderr.write('Classifiers are %s, waiting\n' % (status))
+        time.sleep(poll)
+
+def crawl(products, output, checkpoint_path, fetch_workers=8, classify_workers=8, rate=2.0, burst=4, retry_errors=False, report_every=10.0):
+    done = load_checkpoint(checkpoint_path)
+    if retry_errors:
+        done = dict((prd_id, row) for prd_id, row in done.items() if not row['error'])
+    # the output is rebuilt from the checkpoint, so it always matches it however the previous run ended
+    for row in done.values():
+        output.write(row)
+    todo = [(prd_id, url) for prd_id, url in products if prd_id not in done]
+    progress = Progress(len(done) + len(todo), len(done), report_every)
+
+    limiter = RateLimiter(rate, burst)
+    fetch_pool = ThreadPoolExecutor(max_workers=fetch_workers)
+    classify_pool = ThreadPoolExecutor(max_workers=classify_workers)
+    # bounded so a huge catalog never queues more than a few rounds of work
+    max_in_flight = (fetch_workers + classify_workers) * 2
+    pending = iter(todo)
+    in_flight = {}
+    with io.open(checkpoint_path, 'a', encoding='utf-8') as checkpoint:
+        def finish(row, failed_stage=None):
+            # checkpointed first, a crash before the output is written only means the row is re-emitted on resume
+            checkpoint.write(json.dumps(row) + '\n')
+            checkpoint.flush()
+            output.write(row)
+            progress.count(failed_stage)
+
+        while True:
+            while len(in_flight) < max_in_flight:
+                item = next(pending, None)
+                if item is None:
+                    break
+                in_flight[fetch_pool.submit(_fetch, limiter, *item)] = ('fetch', item, None)
+            if not in_flight:
+                break
+            finished, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage, (prd_id, url), description = in_flight.pop(future)
+                try:
+                    result = future.result()
+                except Exception as details:
+                    finish(_row(prd_id, url, description or '', error=str(details)), stage)
+                    continue
+                if stage == 'fetch':
+                    in_flight[classify_pool.submit(_classify, result)] = ('classify', (prd_id, url), result)
+                else:
+                    finish(_row(prd_id, url, description, *result))
+        os.fsync(checkpoint.fileno())
+    fetch_pool.shutdown()
+    classify_pool.shutdown()
+    output.close()
+    progress.report(final=True)
+    return progress
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fetch, classify and export every product in a list of Kohls.com product ids or urls')
+    parser.add_argument('input', help='file with one product id, prd-id or url per line, - for stdin')
+    parser.add_argument('--output', required=True, help='results file, .csv or .parquet')
+    parser.add_argument('--checkpoint', default=None, help='progress file used to resume, defaults to OUTPUT.checkpoint')
+    parser.add_argument('--fetch-workers', type=int, default=8, help='product pages fetched at once')
+    parser.add_argument('--classify-workers', type=int, default=8, help='descriptions classified at once')
+    parser.add_argument('--rate', type=float, default=2.0, help='page requests per second to each host')
+    parser.add_argument('--burst', type=int, default=4, help='page requests allowed at once before the rate applies')
+    parser.add_argument('--retry-errors', action='store_true', help='try products which failed in an earlier run again')
+    parser.add_argument('--report-every', type=float, default=10.0, help='seconds between progress lines')
+    args = parser.parse_args()
+
+    parquet = args.output.lower().endswith('.parquet')
+    if parquet and pyarrow is None:
+        parser.error('Parquet output requires pyarrow, run "pip install pyarrow" or write a .csv')
+    if args.input == '-':
+        products = list(read_products(sys.stdin))
+    else:
+        with io.open(args.input, encoding='utf-8') as input_file:
+            products = list(read_products(input_file))
+
+    wait_until_ready()
+    output = ParquetOutput(args.output) if parquet else CsvOutput(args.output)
+    crawl(products, output, args.checkpoint or args.output + '.checkpoint', args.fetch_workers, args.classify_workers,
+          args.rate, args.burst, args.retry_errors, args.report_every)
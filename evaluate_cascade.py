@@ -0,0 +1,230 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Measures whether the second level calls of the cascade pay for themselves.  A seeded share of the rows of every
+# training CSV is held out and run through the cascade: the accuracy and most common confusions of each classifier on
+# its own held out rows, how often the top level routes an item to the right second level classifiers, calls per item
+# and time per item.  Every classifier output is recorded once, so a grid of early exit policies can then be replayed
+# offline and compared on calls per item against routing and end to end accuracy.
+#
+#   python evaluate_cascade.py                         local backend trained on the remaining rows
+#   python evaluate_cascade.py --backend watson        the app's deployed classifiers, trained on every row
+
+import argparse
+import csv
+import io
+import json
+import os
+import random
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import welcome
+from local_classifier import LocalClassifierService
+from routing import Router, choose
+
+TOP_LEVEL = welcome.REQ_CLASSIFIERS[0][0]
+
+# early exit policies replayed by the sweep, the thresholds of welcome.ROUTER: skip the second level below a hopeless
+# top level confidence or at and above a conclusive one, and call the branches of both top level candidates when they
+# are within the margin
+HOPELESS = [0.0, 0.1, 0.2, 0.3, 0.4]
+CONCLUSIVE = [None, 0.99, 0.95, 0.9, 0.8]
+MARGINS = [0.0, 0.05, 0.1, 0.2]
+
+def load_rows(path):
+    # (text, label) rows with repeated texts dropped, so no held out text is also trained on
+    rows = []
+    seen = set()
+    with io.open(path, encoding='utf-8', errors='replace', newline='') as training_data:
+        for row in csv.reader(training_data):
+            if len(row) >= 2 and row[0].strip() and row[1].strip() and row[0] not in seen:
+                seen.add(row[0])
+                rows.append((row[0].strip(), row[1].strip()))
+    return rows
+
+def split(rows, holdout, max_items, rng):
+    rows = list(rows)
+    rng.shuffle(rows)
+    count = min(max(1, int(len(rows) * holdout)), max_items)
+    return rows[count:], rows[:count]
+
+def local_backend(train_sets):
+    # fresh classifiers trained only on the rows which are not held out
+    service = LocalClassifierService(background=False)
+    ids = {}
+    for name, rows in train_sets.items():
+        training_data = io.StringIO()
+        csv.writer(training_data).writerows(rows)
+        training_data.seek(0)
+        classifier = service.create_classifier({'name': name, 'language': 'en'}, training_data)
+        if classifier['status'] != 'Available':
+            raise SystemExit('Training %s failed: %s' % (name, classifier.get('status_description')))
+        ids[name] = classifier['classifier_id']
+    return service, ids
+
+def watson_backend(train_sets, poll=5.0):
+    # the classifiers the app uses, which were trained on every row, so held out accuracy is optimistic
+    welcome.REGISTRY.start()
+    while not welcome.REGISTRY.ready:
+        if welcome.REGISTRY.status in ['unconfigured', 'unavailable']:
+            raise SystemExit('Classifiers are %s' % (welcome.REGISTRY.status))
+        time.sleep(poll)
+    return welcome.REGISTRY.service, dict((name, data['id']) for name, data in welcome.REGISTRY.classifiers.items())
+
+BACKENDS = {'local': local_backend, 'watson': watson_backend}
+
+def _call(service, ids, name, text):
+    started = time.time()
+    output = welcome._top_two(service.classify(ids[name], text))
+    return output, time.time() - started
+
+def collect(service, ids, items, workers=8):
+    # one record per held out item with every classifier output any policy in the sweep could ask for: the top level,
+    # the branches of both top level candidates, and the classifier whose CSV the item came from
+    def record(item):
+        source, text, truth = item
+        outputs = {TOP_LEVEL: _call(service, ids, TOP_LEVEL, text)}
+        top = outputs[TOP_LEVEL][0]
+        needed = set(welcome.ROUTER.branch(top['class_1']) + welcome.ROUTER.branch(top['class_2']))
+        if source != TOP_LEVEL:
+            needed.add(source)
+        for name in sorted(needed):
+            outputs[name] = _call(service, ids, name, text)
+        return {'source': source, 'truth': truth, 'outputs': outputs}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(record, items))
+
+def score(records, policy):
+    # replays the app's routing under a policy, the same choice between fanned out branches included
+    router = Router(welcome.ROUTES, [name for name, _ in welcome.REQ_CLASSIFIERS], **policy)
+    calls = 0
+    seconds = 0.0
+    routed = 0
+    second_total = second_correct = 0
+    for record in records:
+        candidates = router.route(record['outputs'][TOP_LEVEL][0])
+        called = sorted(set(name for _, _, branch in candidates for name in branch))
+        calls += 1 + len(called)
+        # an estimate of the item's latency from the recorded calls: the second level calls run concurrently, so only the
+        # slowest one adds to the time.  Calls were recorded --workers at a time, which a busy backend slows down
+        seconds += record['outputs'][TOP_LEVEL][1] + max([record['outputs'][name][1] for name in called] or [0.0])
+        outputs = dict((name, record['outputs'][name][0]) for name in called)
+        chosen = candidates[0] if len(candidates) == 1 else choose(candidates, outputs)
+        branch = chosen[2] if chosen else []
+        if record['source'] == TOP_LEVEL:
+            # the branch its true top level class leads to
+            routed += branch == router.branch(record['truth'])
+        else:
+            routed += record['source'] in branch
+            second_total += 1
+            second_correct += record['source'] in branch and record['outputs'][record['source']][0]['class_1'] == record['truth']
+    return {'policy': policy, 'calls_per_item': calls / float(len(records)), 'est_ms_per_item': seconds * 1000 / len(records),
+            'routing_accuracy': routed / float(len(records)),
+            'second_level_accuracy': second_correct / float(second_total) if second_total else 0.0}
+
+def level_report(records, top_confusions=5):
+    # each classifier on its own held out rows, regardless of routing
+    levels = {}
+    for record in records:
+        output, seconds = record['outputs'][record['source']]
+        level = levels.setdefault(record['source'], {'items': 0, 'correct': 0, 'seconds': 0.0, 'confusions': Counter()})
+        level['items'] += 1
+        level['seconds'] += seconds
+        if output['class_1'] == record['truth']:
+            level['correct'] += 1
+        else:
+            level['confusions'][(record['truth'], output['class_1'])] += 1
+    return dict((name, {'items': level['items'], 'accuracy': level['correct'] / float(level['items']),
+                        'ms_per_call': level['seconds'] * 1000 / level['items'],
+                        'confusions': [{'expected': expected, 'predicted': predicted, 'count': count}
+                                       for (expected, predicted), count in level['confusions'].most_common(top_confusions)]})
+                for name, level in levels.items())
+
+def sweep(records):
+    results = []
+    for hopeless in HOPELESS:
+        for conclusive in CONCLUSIVE:
+            for margin in MARGINS:
+                results.append(score(records, {'hopeless': hopeless, 'conclusive': conclusive, 'margin': margin}))
+    return results
+
+def pareto(results):
+    # policies which no other policy beats on calls without also losing end to end accuracy
+    front = []
+    for result in sorted(results, key=lambda r: (r['calls_per_item'], -r['second_level_accuracy'])):
+        if not front or result['second_level_accuracy'] > front[-1]['second_level_accuracy']:
+            front.append(result)
+    return front
+
+def recommend(results, current, max_loss):
+    # the cheapest policy losing at most max_loss of routing and end to end accuracy against the current routing, which
+    # always qualifies itself whether or not it is one of the grid points
+    acceptable = [result for result in results + [current]
+                  if result['second_level_accuracy'] >= current['second_level_accuracy'] - max_loss
+                  and result['routing_accuracy'] >= current['routing_accuracy'] - max_loss]
+    return min(acceptable, key=lambda r: (r['calls_per_item'], -r['second_level_accuracy']))
+
+def _policy_label(policy):
+    return 'hopeless<%.2f conclusive>=%s margin<%.2f' % (policy['hopeless'], 'never' if policy['conclusive'] is None else '%.2f' % (policy['conclusive']), policy['margin'])
+
+def print_report(levels, current, front, recommended):
+    print('%-32s %6s %9s %8s' % ('classifier', 'items', 'accuracy', 'ms/call'))
+    for name, level in sorted(levels.items()):
+        print('%-32s %6d %9.3f %8.2f' % (name, level['items'], level['accuracy'], level['ms_per_call']))
+        for confusion in level['confusions']:
+            print('    %4d  %s -> %s' % (confusion['count'], confusion['expected'], confusion['predicted']))
+    print('')
+    print('%-64s %10s %9s %9s %9s' % ('policy', 'calls/item', 'est ms', 'routing', 'second'))
+    rows = [('current routing', current)] + [(_policy_label(result['policy']), result) for result in front]
+    rows.append(('recommended: ' + _policy_label(recommended['policy']), recommended))
+    for label, result in rows:
+        print('%-64s %10.2f %9.2f %9.3f %9.3f' % (label, result['calls_per_item'], result['est_ms_per_item'], result['routing_accuracy'], result['second_level_accuracy']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Hold out rows of every training CSV and measure the classifier cascade on them')
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default='local',
+                        help='local trains fresh classifiers without the held out rows, watson uses the deployed ones')
+    parser.add_argument('--holdout', type=float, default=0.1, help='share of each CSV held out')
+    parser.add_argument('--max-items', type=int, default=500, help='most rows held out of each CSV')
+    parser.add_argument('--workers', type=int, default=8, help='items evaluated at once')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--show', type=int, default=10, help='most accurate policies of the cost/accuracy front to list')
+    parser.add_argument('--max-loss', type=float, default=0.01, help='accuracy the recommended policy may give up to save calls')
+    parser.add_argument('--json', default=None, help='also write every result, including the full sweep, to this file')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    train_sets = {}
+    items = []
+    for name, data_set in welcome.REQ_CLASSIFIERS:
+        train, test = split(load_rows(os.path.join(welcome.data_folder, data_set)), args.holdout, args.max_items, rng)
+        train_sets[name] = train
+        items.extend((name, text, label) for text, label in test)
+    # the same product text appears in the top level CSV and in its second level one, a text held out of any CSV is kept
+    # out of the training rows of every classifier so no level has seen it
+    held_out = set(text for _, text, _ in items)
+    train_sets = dict((name, [row for row in rows if row[0] not in held_out]) for name, rows in train_sets.items())
+
+    service, ids = BACKENDS[args.backend](train_sets)
+    sys.stderr.write('Evaluating %d held out items\n' % (len(items)))
+    records = collect(service, ids, items, args.workers)
+    levels = level_report(records)
+    current = score(records, {'hopeless': welcome.ROUTER.hopeless, 'conclusive': welcome.ROUTER.conclusive, 'margin': welcome.ROUTER.margin})
+    results = sweep(records)
+    recommended = recommend(results, current, args.max_loss)
+    print_report(levels, current, pareto(results)[-args.show:], recommended)
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump({'levels': levels, 'current': current, 'recommended': recommended, 'sweep': results}, output, indent=2, sort_keys=True)
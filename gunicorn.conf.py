@@ -0,0 +1,56 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Production serving with gunicorn: WEB_CONCURRENCY worker processes each running WEB_THREADS threads.  The master
+# discovers the classifiers once before forking and publishes them to REGISTRY_STORE, after which one worker at a time
+# polls the NLC service and the others read the shared file.  Each worker also writes its metrics to METRICS_DIR, so
+# /metrics reports the whole server whichever worker answers the scrape.
+#
+#   gunicorn -c gunicorn.conf.py welcome:app
+
+import os
+import tempfile
+
+bind = '0.0.0.0:%s' % (os.getenv('PORT', '5000'))
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+threads = int(os.getenv('WEB_THREADS', '8'))
+worker_class = 'gthread'
+# a cascade plus a Kohl's page fetch stays well under this even when the services are slow
+timeout = int(os.getenv('WEB_TIMEOUT', '60'))
+graceful_timeout = 30
+accesslog = '-'
+
+# set before welcome is imported, one store per port so several servers on a host stay apart
+os.environ.setdefault('REGISTRY_STORE', os.path.join(tempfile.gettempdir(), 'nlc_registry_%s.json' % (os.getenv('PORT', '5000'))))
+os.environ.setdefault('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'nlc_metrics_%s' % (os.getenv('PORT', '5000'))))
+
+def on_starting(server):
+    # imported in the master so the workers inherit the discovered registry instead of each re-deriving it
+    import metrics
+    import welcome
+    # counters start again from zero with a new server, left over snapshots would be added to them
+    metrics.clear_shared(welcome.METRICS_DIR)
+    try:
+        (all_classifiers, classifier_status, _), failed = welcome.warm_up()
+    except Exception as details:
+        # still serve, the workers keep polling and report not ready until it succeeds
+        server.log.warning('Classifier warm up failed: %s', details)
+        return
+    server.log.info('Classifiers %s: %s', classifier_status, ', '.join('%s %s' % (name, data['status']) for name, data in sorted(all_classifiers.items())))
+    for name, details in failed:
+        server.log.warning('Warm up call to %s failed: %s', name, details)
+
+def post_worker_init(worker):
+    # each worker shares its metrics and follows the registry store, or takes over the polling when nobody else holds it
+    import welcome
+    welcome.METRICS.share(welcome.METRICS_DIR)
+    welcome.REGISTRY.start()
@@ -0,0 +1,159 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Fetches Kohl's product pages and extracts the product description.  All requests share one connection pooled
+# session, have timeouts and a bounded number of retries with exponential backoff, and pages are cached by product id
+# and revalidated with ETag/Last-Modified so an unchanged page is never downloaded or parsed twice.
+
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from lxml import html
+
+KOHLS_PRODUCT_PREFIX = 'www.kohls.com/product/prd-'
+
+# product description limits, in characters then words
+MAX_CHARS = 1000
+MAX_WORDS = 120
+
+# text nodes which are page furniture rather than description
+_SKIP_NODES = frozenset(['PRODUCT FEATURES', '\r', '\n'])
+# control characters are dropped outright, runs of spaces collapsed to one
+_CONTROL_CHARS = dict((char, None) for char in range(1, 32))
+_SPACES = re.compile(r' {2,}')
+
+# responses worth trying again
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+def product_id(url):
+    # the product id for a Kohl's product page, None for anything else
+    if url[8:34] != KOHLS_PRODUCT_PREFIX:
+        return None
+    return url.split('/prd-')[1].split('/')[0]
+
+def extract_description(content, prd_id):
+    # parse html using xpath, only the product details block is needed
+    tree = html.fromstring(content)
+    raw_desc = tree.xpath('//*[@id="%s_productDetails"]/div/descendant::*/text()' % (prd_id))
+    return normalize_description(' '.join([i for i in raw_desc if i not in _SKIP_NODES]))
+
+def normalize_description(desc):
+    # single linear pass over the text, then cut down to the size the classifier accepts
+    desc = _SPACES.sub(' ', desc.translate(_CONTROL_CHARS))
+    return ' '.join(desc[:MAX_CHARS].split(' ')[:MAX_WORDS])
+
+class KohlsPageFetcher(object):
+    def __init__(self, timeout=(3.05, 10), retries=2, backoff=0.5, pool_size=20, cache_size=5000, base_url=None):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.cache_size = cache_size
+        # fetch from somewhere other than www.kohls.com, e.g. a local stand in
+        self.base_url = base_url
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'fetches': 0, 'not_modified': 0, 'retries': 0, 'failures': 0, 'fetch_seconds': 0.0, 'parse_seconds': 0.0}
+
+    def fetch(self, url):
+        # returns the description plus how long the fetch and the parse took, or None if this is not a Kohl's product page
+        prd_id = product_id(url)
+        if prd_id is None:
+            return None
+        cached, headers = self.revalidation(prd_id)
+        started = time.time()
+        response = self._get(self.page_url(url), headers)
+        return self.complete(prd_id, cached, response.status_code, response.content, response.headers, time.time() - started)
+
+    def revalidation(self, prd_id):
+        # the cached page, if any, and the headers which revalidate it rather than re-download it
+        with self._lock:
+            cached = self._cache.get(prd_id)
+        headers = {}
+        if cached is not None:
+            if cached['etag']:
+                headers['If-None-Match'] = cached['etag']
+            if cached['last_modified']:
+                headers['If-Modified-Since'] = cached['last_modified']
+        return cached, headers
+
+    def complete(self, prd_id, cached, status_code, content, headers, fetch_seconds):
+        # the fetch result from a response, the cached description if the page was not modified
+        if status_code == 304 and cached is not None:
+            self._record(fetch_seconds, 0.0, not_modified=True)
+            return {'product_id': prd_id, 'description': cached['description'], 'cached': True,
+                    'fetch_seconds': fetch_seconds, 'parse_seconds': 0.0}
+
+        started = time.time()
+        description = extract_description(content, prd_id)
+        parse_seconds = time.time() - started
+        self._store(prd_id, description, headers)
+        self._record(fetch_seconds, parse_seconds)
+        return {'product_id': prd_id, 'description': description, 'cached': False,
+                'fetch_seconds': fetch_seconds, 'parse_seconds': parse_seconds}
+
+    def count(self, event):
+        # retries and failures, also counted for fetches made elsewhere such as async_app.py
+        with self._lock:
+            self._stats[event] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['cached_pages'] = len(self._cache)
+        return stats
+
+    def page_url(self, url):
+        if not self.base_url:
+            return url
+        return self.base_url.rstrip('/') + '/' + url.split('www.kohls.com/', 1)[1]
+
+    def _get(self, url, headers):
+        # bounded retry with exponential backoff on connection errors and retryable statuses
+        attempt = 0
+        while True:
+            try:
+                response = self.session.get(url, headers=headers, timeout=self.timeout)
+                if response.status_code not in RETRY_STATUSES:
+                    if response.status_code != 304:
+                        response.raise_for_status()
+                    return response
+                error = requests.HTTPError('%s returned %s' % (url, response.status_code), response=response)
+            except (requests.ConnectionError, requests.Timeout) as details:
+                error = details
+            if attempt >= self.retries:
+                self.count('failures')
+                raise error
+            self.count('retries')
+            time.sleep(self.backoff * (2 ** attempt))
+            attempt += 1
+
+    def _store(self, prd_id, description, headers):
+        with self._lock:
+            self._cache[prd_id] = {'description': description, 'etag': headers.get('ETag'),
+                                   'last_modified': headers.get('Last-Modified')}
+            self._cache.move_to_end(prd_id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _record(self, fetch_seconds, parse_seconds, not_modified=False):
+        with self._lock:
+            self._stats['fetches'] += 1
+            self._stats['not_modified'] += not_modified
+            self._stats['fetch_seconds'] += fetch_seconds
+            self._stats['parse_seconds'] += parse_seconds
@@ -0,0 +1,131 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# In-process stand in for NaturalLanguageClassifierV1.  It implements the same list_classifiers / get_classifier /
+# create_classifier / classify surface used by welcome.py, so it can be dropped in behind _classify without the rest
+# of the app knowing the difference.  Each classifier is a TF-IDF vectorizer feeding a multinomial logistic regression,
+# scored directly on the sparse matrices which keeps a single classification well under a millisecond.
+
+import csv
+import datetime
+import io
+import json
+import threading
+import uuid
+
+# scikit-learn is only needed for the local backend, the app runs against Watson without it
+try:
+    import numpy as np
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.linear_model import LogisticRegression
+except ImportError:
+    np = None
+
+# the Watson service returns at most 10 classes per classification
+MAX_CLASSES = 10
+
+class LocalClassifierService(object):
+    def __init__(self, background=True):
+        if np is None:
+            raise ImportError('The local classifier backend requires numpy and scikit-learn, run "pip install scikit-learn"')
+        # train on a separate thread so create_classifier returns straight away with a Training status, like the remote service
+        self.background = background
+        self._classifiers = {}
+        self._lock = threading.Lock()
+
+    def list_classifiers(self):
+        with self._lock:
+            return {'classifiers': [self._describe(data) for data in self._classifiers.values()]}
+
+    def get_classifier(self, classifier_id):
+        return self._describe(self._get(classifier_id))
+
+    def create_classifier(self, metadata, training_data):
+        metadata = json.loads(metadata) if not isinstance(metadata, dict) else metadata
+        # read everything up front, the caller closes the file as soon as this returns
+        rows = _read_training_rows(training_data)
+        data = {'classifier_id': uuid.uuid4().hex[:10] + '-nlc-local', 'name': metadata.get('name'),
+                'language': metadata.get('language', 'en'), 'status': 'Training', 'model': None,
+                'created': datetime.datetime.utcnow().isoformat() + 'Z'}
+        with self._lock:
+            self._classifiers[data['classifier_id']] = data
+        if self.background:
+            worker = threading.Thread(target=self._train, args=(data, rows), name='train-%s' % (data['name']))
+            worker.daemon = True
+            worker.start()
+        else:
+            self._train(data, rows)
+        return self._describe(data)
+
+    def delete_classifier(self, classifier_id):
+        with self._lock:
+            self._classifiers.pop(classifier_id, None)
+        return {}
+
+    def classify(self, classifier_id, text):
+        return self.classify_batch(classifier_id, [text])[0]
+
+    def classify_batch(self, classifier_id, texts):
+        # score a list of texts in one sparse matrix product
+        data = self._get(classifier_id)
+        if data['status'] != 'Available':
+            raise Exception('Classifier %s is %s' % (classifier_id, data['status']))
+        vectorizer, coef, intercept, labels = data['model']
+        scores = vectorizer.transform(texts).dot(coef) + intercept
+        # softmax, shifted by the row max for numerical stability
+        scores = np.exp(scores - scores.max(axis=1)[:, None])
+        scores /= scores.sum(axis=1)[:, None]
+        top = np.argsort(-scores, axis=1)[:, :MAX_CLASSES]
+
+        results = []
+        for text, row, order in zip(texts, scores, top):
+            classes = [{'class_name': labels[i], 'confidence': float(row[i])} for i in order]
+            results.append({'classifier_id': classifier_id, 'text': text, 'top_class': classes[0]['class_name'], 'classes': classes})
+        return results
+
+    def _get(self, classifier_id):
+        with self._lock:
+            if classifier_id not in self._classifiers:
+                raise Exception('Classifier not found: %s' % (classifier_id))
+            return self._classifiers[classifier_id]
+
+    def _describe(self, data):
+        return dict((key, value) for key, value in data.items() if key != 'model')
+
+    def _train(self, data, rows):
+        try:
+            texts = [text for text, _ in rows]
+            labels = [label for _, label in rows]
+            if len(set(labels)) < 2:
+                raise ValueError('Training data for %s needs at least two classes' % (data['name']))
+            vectorizer = TfidfVectorizer(sublinear_tf=True, ngram_range=(1, 2), min_df=2)
+            model = LogisticRegression(C=10, max_iter=1000)
+            model.fit(vectorizer.fit_transform(texts), labels)
+            coef, intercept = model.coef_, model.intercept_
+            if len(model.classes_) == 2:
+                # a binary model has a single score for the second class, softmax over (0, score) is its sigmoid, so both
+                # classes get a probability just as in the multi-class case
+                coef = np.vstack([np.zeros_like(coef), coef])
+                intercept = np.concatenate([np.zeros_like(intercept), intercept])
+            # keep only what scoring needs, transposed so a (texts x features) matrix can be multiplied straight through
+            data['model'] = (vectorizer, coef.T.copy(), intercept.copy(), [str(label) for label in model.classes_])
+            data['status'] = 'Available'
+        except Exception as details:
+            data['status'] = 'Failed'
+            data['status_description'] = str(details)
+
+def _read_training_rows(training_data):
+    # same format the Watson service accepts: text, class
+    raw = training_data.read()
+    if isinstance(raw, bytes):
+        raw = raw.decode('utf-8', 'replace')
+    return [(row[0], row[1]) for row in csv.reader(io.StringIO(raw)) if len(row) >= 2 and row[0] and row[1]]
@@ -0,0 +1,287 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Minimal in-process metrics with Prometheus text exposition: counters, gauges and latency histograms, each with
+# optional labels.  Alongside the process wide metrics, a per-request record of stage timings and remote call counts
+# is kept in a context variable so it follows a request onto worker pool threads.
+#
+# Under a pre-fork server each worker keeps its own values, so a scrape would only see whichever worker answered it.
+# After share(directory) a worker writes a snapshot of its samples to the directory every few seconds, and a scrape
+# answered by any worker adds up the counters and histograms of every snapshot, exited workers included, so totals never
+# go backwards.  Gauges are reported for each live worker under a pid label.
+
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# latency buckets in seconds, from a local classification up to a very slow remote call
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# stage timings and remote call count of the request being handled, None outside a request
+_REQUEST = contextvars.ContextVar('request_metrics', default=None)
+
+def _format_labels(label_names, values, extra=None):
+    pairs = list(zip(label_names, values)) + (extra or [])
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in pairs)
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.label_names)
+
+    def samples(self):
+        # (sample name, [(label, value)], value) for every labelled value
+        with self._lock:
+            return [(self.name, list(zip(self.label_names, key)), value) for key, value in sorted(self._values.items())]
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts, _, _ = data = self._values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            data[1] += value
+            data[2] += 1
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                labels = list(zip(self.label_names, key))
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    samples.append((self.name + '_bucket', labels + [('le', _format_value(bound))], cumulative))
+                samples.append((self.name + '_sum', labels, total))
+                samples.append((self.name + '_count', labels, count))
+        return samples
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self._metrics = []
+        # callables returning (name, kind, documentation, {label dict: value}) for values read at scrape time
+        self._collectors = []
+        self.directory = None
+        self._snapshot = None
+
+    def counter(self, name, documentation, label_names=()):
+        return self._add(Counter(name, documentation, label_names))
+
+    def gauge(self, name, documentation, label_names=()):
+        return self._add(Gauge(name, documentation, label_names))
+
+    def histogram(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, documentation, label_names, buckets))
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def share(self, directory, interval=2.0):
+        # called once in each worker process after the fork.  The snapshot is named after the pid and start time, so a
+        # later process reusing the pid never overwrites an exited worker's totals
+        self.directory = directory
+        # anything recorded before the fork was the master's, every worker would otherwise report it again
+        for metric in self._metrics:
+            with metric._lock:
+                metric._values = {}
+        self._snapshot = os.path.join(directory, '%d-%d.json' % (os.getpid(), int(time.time() * 1000)))
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        self._write_snapshot()
+        writer = threading.Thread(target=self._snapshot_loop, args=(interval,), name='metrics-snapshot')
+        writer.daemon = True
+        writer.start()
+
+    def families(self):
+        # name -> (kind, documentation, [(sample name, [(label, value)], value)]).  Several collectors may report samples
+        # of the same metric, each is written under a single HELP and TYPE
+        families = OrderedDict()
+        for metric in self._metrics:
+            families[metric.name] = (metric.kind, metric.documentation, metric.samples())
+        for collector in self._collectors:
+            for name, kind, documentation, samples in collector():
+                families.setdefault(name, (kind, documentation, []))[2].extend((name, list(labels.items()), value) for labels, value in samples)
+        return families
+
+    def render(self):
+        families = self.families() if self.directory is None else self._shared_families()
+        lines = []
+        for name, (kind, documentation, samples) in families.items():
+            lines.append('# HELP %s %s' % (name, documentation))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for sample_name, labels, value in samples:
+                lines.append('%s%s %s' % (sample_name, _format_labels([label for label, _ in labels], [v for _, v in labels]), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def _write_snapshot(self):
+        temporary = self._snapshot + '.tmp'
+        with open(temporary, 'w') as snapshot:
+            json.dump([[name, kind, documentation, samples] for name, (kind, documentation, samples) in self.families().items()], snapshot)
+        os.replace(temporary, self._snapshot)
+
+    def _snapshot_loop(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self._write_snapshot()
+            except Exception:
+                # a full or missing directory only costs this worker's latest numbers, try again next time
+                pass
+
+    def _shared_families(self):
+        # this worker's snapshot is refreshed first so its own numbers are current
+        self._write_snapshot()
+        families = OrderedDict()
+        totals = {}
+        for filename in sorted(os.listdir(self.directory)):
+            if not filename.endswith('.json'):
+                continue
+            pid = filename.split('-', 1)[0]
+            try:
+                with open(os.path.join(self.directory, filename)) as snapshot:
+                    loaded = json.load(snapshot)
+            except (OSError, ValueError):
+                continue
+            alive = _alive(int(pid))
+            for name, kind, documentation, samples in loaded:
+                kind, documentation, merged = families.setdefault(name, (kind, documentation, []))
+                for sample_name, labels, value in samples:
+                    labels = [tuple(pair) for pair in labels]
+                    if kind == 'gauge':
+                        # a gauge is a current value, only meaningful for a worker which is still running
+                        if alive:
+                            merged.append((sample_name, labels + [('pid', pid)], value))
+                        continue
+                    key = (sample_name, tuple(labels))
+                    if key not in totals:
+                        totals[key] = [sample_name, labels, 0]
+                        merged.append(totals[key])
+                    totals[key][2] += value
+        return families
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+def clear_shared(directory):
+    # a fresh server starts its counters from zero, called by the pre-fork master before any worker starts
+    if os.path.isdir(directory):
+        for filename in os.listdir(directory):
+            if filename.endswith('.json') or filename.endswith('.tmp'):
+                os.remove(os.path.join(directory, filename))
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # exists, owned by someone else
+        return True
+    return True
+
+def start_request():
+    # begin collecting stage timings and remote calls for the current request
+    record = {'stages': {}, 'remote_calls': 0}
+    _REQUEST.set(record)
+    return record
+
+def end_request():
+    _REQUEST.set(None)
+
+def count_remote_call():
+    record = _REQUEST.get()
+    if record is not None:
+        record['remote_calls'] += 1
+
+def record_stage(stage, seconds):
+    record = _REQUEST.get()
+    if record is not None:
+        record['stages'][stage] = record['stages'].get(stage, 0.0) + seconds
+
+@contextmanager
+def timed(histogram, record_as=None, **labels):
+    # observe the block's duration, and add it to the current request's stage timings under record_as when given
+    started = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - started
+        histogram.observe(elapsed, **labels)
+        if record_as is not None:
+            record_stage(record_as, elapsed)
+
+def server_timing(record):
+    # Server-Timing header value, durations in milliseconds
+    return ', '.join('%s;dur=%.2f' % (stage, seconds * 1000) for stage, seconds in sorted(record['stages'].items()))
+
+def submit_in_context(executor, fn, *args):
+    # executor.submit which carries the current request's metrics record over to the worker thread
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+def in_context(fn):
+    # wrap fn so every call runs with the current request's metrics record, for use with executor.map
+    context = contextvars.copy_context()
+    return lambda *args: context.copy().run(fn, *args)
@@ -0,0 +1,145 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Streaming preparation of the training CSVs before they are uploaded.  Rows are validated, de-duplicated and truncated
+# to the service limits, classes with too few examples are dropped, and the class balance is reported.  Each prepared
+# file gets a content hash which is used to version the classifier trained from it, so only classifiers whose data
+# actually changed are retrained.
+#
+#   python prepare_data.py            prepare every dataset in REQ_CLASSIFIERS and print a report
+
+import csv
+import hashlib
+import io
+import json
+import os
+from collections import Counter
+
+# the NLC service rejects text over 1024 characters
+MAX_TEXT_CHARS = 1024
+# classes with fewer examples than this are dropped rather than discovered after a slow remote training run
+MIN_CLASS_EXAMPLES = 2
+# the service needs at least this many classes to train
+MIN_CLASSES = 2
+
+MANIFEST = 'manifest.json'
+
+def _rows(path):
+    # one (text, label) row at a time, None for a row which cannot be used
+    with io.open(path, encoding='utf-8', errors='replace', newline='') as training_data:
+        for row in csv.reader(training_data):
+            if len(row) < 2 or not row[0].strip() or not row[1].strip():
+                yield None
+            else:
+                yield row[0].strip(), row[1].strip()
+
+def prepare_dataset(source, destination, max_chars=MAX_TEXT_CHARS, min_class_examples=MIN_CLASS_EXAMPLES):
+    # two streaming passes: the first counts classes so stray ones can be dropped, the second writes the cleaned rows
+    class_counts = Counter(row[1] for row in _rows(source) if row is not None)
+    stray = set(label for label, count in class_counts.items() if count < min_class_examples)
+
+    report = {'source': os.path.basename(source), 'rows_in': 0, 'rows_out': 0, 'invalid': 0, 'duplicates': 0,
+              'truncated': 0, 'stray_rows': 0, 'stray_classes': sorted(stray)}
+    kept = Counter()
+    seen = set()
+    digest = hashlib.sha256()
+    # named per process, several workers may prepare the same file at once and the last to finish wins
+    temporary = '%s.%d.tmp' % (destination, os.getpid())
+    with io.open(temporary, 'w', encoding='utf-8', newline='') as prepared:
+        writer = csv.writer(prepared)
+        for row in _rows(source):
+            report['rows_in'] += 1
+            if row is None:
+                report['invalid'] += 1
+                continue
+            text, label = row
+            if label in stray:
+                report['stray_rows'] += 1
+                continue
+            if len(text) > max_chars:
+                text = text[:max_chars]
+                report['truncated'] += 1
+            # identical text and label pairs only teach the classifier the same thing twice
+            key = hashlib.sha1((text + '\x00' + label).encode('utf-8')).digest()
+            if key in seen:
+                report['duplicates'] += 1
+                continue
+            seen.add(key)
+            line = io.StringIO()
+            csv.writer(line).writerow([text, label])
+            digest.update(line.getvalue().encode('utf-8'))
+            writer.writerow([text, label])
+            kept[label] += 1
+            report['rows_out'] += 1
+    os.replace(temporary, destination)
+
+    report['classes'] = dict(kept)
+    report['sha256'] = digest.hexdigest()
+    if kept:
+        report['smallest_class'] = min(kept.values())
+        report['largest_class'] = max(kept.values())
+    if len(kept) < MIN_CLASSES:
+        report['error'] = 'Only %d classes left after preparation, at least %d are needed' % (len(kept), MIN_CLASSES)
+    return report
+
+def prepare_all(req_classifiers, data_folder, prepared_folder, force=False):
+    # prepare every dataset, reusing earlier output whose source file has not changed since
+    if not os.path.isdir(prepared_folder):
+        os.makedirs(prepared_folder, exist_ok=True)
+    manifest_path = os.path.join(prepared_folder, MANIFEST)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+
+    changed = False
+    for name, data_set in req_classifiers:
+        source = os.path.join(data_folder, data_set)
+        destination = os.path.join(prepared_folder, data_set)
+        stat = os.stat(source)
+        previous = manifest.get(name)
+        if (not force and previous is not None and os.path.exists(destination)
+                and previous.get('source_mtime') == stat.st_mtime and previous.get('source_size') == stat.st_size):
+            continue
+        report = prepare_dataset(source, destination)
+        report.update(path=destination, source_mtime=stat.st_mtime, source_size=stat.st_size)
+        manifest[name] = report
+        changed = True
+
+    if changed:
+        # written atomically so a concurrent reader never sees half a manifest
+        temporary = '%s.%d.tmp' % (manifest_path, os.getpid())
+        with open(temporary, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+        os.replace(temporary, manifest_path)
+    return dict((name, manifest[name]) for name, _ in req_classifiers)
+
+def print_report(manifest):
+    for name, report in manifest.items():
+        print('%s  (%s)' % (name, report['source']))
+        print('  rows in %d, out %d, invalid %d, duplicates %d, truncated %d, stray rows %d' % (
+            report['rows_in'], report['rows_out'], report['invalid'], report['duplicates'], report['truncated'], report['stray_rows']))
+        print('  %d classes, smallest %s, largest %s, sha256 %s' % (
+            len(report['classes']), report.get('smallest_class'), report.get('largest_class'), report['sha256'][:12]))
+        if report['stray_classes']:
+            print('  dropped stray classes: %s' % (', '.join(report['stray_classes'])))
+        if 'error' in report:
+            print('  ERROR: %s' % (report['error']))
+
+if __name__ == '__main__':
+    import argparse
+    import welcome
+
+    parser = argparse.ArgumentParser(description='Validate, de-duplicate and truncate the training data and report class balance')
+    parser.add_argument('--force', action='store_true', help='prepare every dataset even if its source is unchanged')
+    args = parser.parse_args()
+    print_report(prepare_all(welcome.REQ_CLASSIFIERS, welcome.data_folder, welcome.PREPARED_FOLDER, force=args.force))
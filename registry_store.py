@@ -0,0 +1,85 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# File backed classifier registry state shared by the worker processes of a pre-fork server.  One process at a time
+# holds an exclusive lock on a sibling .lock file and is the only one which polls the NLC service; it publishes each
+# (classifiers, status, ready) state by atomically replacing a JSON file, which every other process re-reads once its
+# modification time changes.  The lock is released by the kernel when its holder exits, so another worker takes over.
+
+import json
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # no advisory locks, every process polls for itself
+    fcntl = None
+
+class RegistryStore(object):
+    def __init__(self, path, check_interval=1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock_file = None
+        self._mtime = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def try_lock(self):
+        # True if this process owns the registry, taking ownership when nobody else holds it
+        if fcntl is None:
+            return True
+        if self._lock_file is not None:
+            return True
+        lock_file = open(self.path + '.lock', 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def release(self):
+        # must happen before a fork, children would otherwise share the lock with their parent
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def write(self, state):
+        classifiers, status, ready = state
+        temporary = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(temporary, 'w') as store:
+            json.dump({'classifiers': classifiers, 'status': status, 'ready': ready, 'updated': time.time()}, store)
+        # readers only ever see the old or the new file, never half of one
+        os.replace(temporary, self.path)
+
+    def read(self):
+        # (state, updated time) if the file changed since the last read, otherwise None.  The file is stat'ed at most
+        # once per check_interval so reading on every request stays cheap
+        now = time.time()
+        with self._lock:
+            if now - self._checked < self.check_interval:
+                return None
+            self._checked = now
+            try:
+                mtime = os.stat(self.path).st_mtime
+                if mtime == self._mtime:
+                    return None
+                with open(self.path) as store:
+                    data = json.load(store)
+            except (IOError, OSError, ValueError):
+                # not written yet
+                return None
+            self._mtime = mtime
+        return (data['classifiers'], data['status'], data['ready']), data['updated']
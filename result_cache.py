@@ -0,0 +1,159 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Content addressed cache for classification results.  Entries are keyed on a hash of the normalized input text plus
+# a fingerprint of the classifier ids that produced them, so retraining a classifier (which gives it a new id)
+# automatically stops old results from being served.  A bounded in-memory LRU sits in front of an optional SQLite file
+# which survives restarts, capped at max_disk_entries rows with the oldest written dropped first.  The two tiers have
+# their own locks, so a lookup answered from memory never waits on a disk write.
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+
+_WHITESPACE = re.compile(r'\s+')
+
+def normalize_text(text):
+    # the same description re-submitted with different spacing or unicode composition should hit the same entry
+    return _WHITESPACE.sub(' ', unicodedata.normalize('NFC', text)).strip()
+
+def classifier_fingerprint(all_classifiers):
+    # changes whenever any classifier is retrained and picks up a new id
+    return ','.join('%s:%s' % (name, all_classifiers[name]['id']) for name in sorted(all_classifiers))
+
+class ResultCache(object):
+    def __init__(self, max_entries=10000, path=None, max_disk_entries=100000):
+        self.max_entries = max_entries
+        self.path = path
+        self.max_disk_entries = max_disk_entries
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.disk_evictions = 0
+        self.disk_invalidations = 0
+        self._memory = OrderedDict()
+        self._fingerprint = None
+        self._disk_fingerprint = None
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._connection = None
+        self._connection_pid = None
+        if path:
+            self._db.close()
+            self._connection_pid = None
+
+    @property
+    def _db(self):
+        # one connection shared between threads, every use is serialized by self._db_lock.  A connection must not cross
+        # a fork, so each worker of a pre-fork server opens its own on first use
+        if self.path and self._connection_pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, check_same_thread=False, timeout=10)
+            # readers never block the writer, and a commit no longer waits for an fsync of its own
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, fingerprint TEXT, value TEXT)')
+            self._connection.commit()
+            self._connection_pid = os.getpid()
+        return self._connection
+
+    def key(self, text, fingerprint):
+        return hashlib.sha256((normalize_text(text) + '\x00' + fingerprint).encode('utf-8')).hexdigest()
+
+    def get(self, text, fingerprint):
+        key = self.key(text, fingerprint)
+        with self._lock:
+            self._check_fingerprint(fingerprint)
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return json.loads(self._memory[key])
+        value = self._disk_get(key, fingerprint) if self.path else None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            # promote to the memory tier, unless the classifiers changed while the disk was read
+            if fingerprint == self._fingerprint:
+                self._store_memory(key, value)
+            self.hits += 1
+            self.disk_hits += 1
+        return json.loads(value)
+
+    def put(self, text, fingerprint, value):
+        key = self.key(text, fingerprint)
+        # stored serialized so callers can never mutate a cached result
+        value = json.dumps(value)
+        with self._lock:
+            self._check_fingerprint(fingerprint)
+            self._store_memory(key, value)
+        if self.path:
+            self._disk_put(key, fingerprint, value)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+        if self.path:
+            with self._db_lock:
+                self._db.execute('DELETE FROM results')
+                self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'disk_evictions': self.disk_evictions, 'invalidations': self.invalidations + self.disk_invalidations,
+                    'entries': len(self._memory), 'max_entries': self.max_entries, 'persistent': bool(self.path)}
+
+    def _store_memory(self, key, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.evictions += 1
+
+    def _check_fingerprint(self, fingerprint):
+        # a new fingerprint means a classifier was retrained, drop everything produced by the old ones
+        if fingerprint == self._fingerprint:
+            return
+        if self._fingerprint is not None:
+            self.invalidations += len(self._memory)
+            self._memory.clear()
+        self._fingerprint = fingerprint
+
+    def _disk_get(self, key, fingerprint):
+        with self._db_lock:
+            self._check_disk_fingerprint(fingerprint)
+            row = self._db.execute('SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def _disk_put(self, key, fingerprint, value):
+        with self._db_lock:
+            self._check_disk_fingerprint(fingerprint)
+            self._db.execute('INSERT OR REPLACE INTO results (key, fingerprint, value) VALUES (?, ?, ?)', (key, fingerprint, value))
+            # a written row always gets the highest rowid, so everything more than the cap behind it is the oldest
+            self.disk_evictions += self._db.execute('DELETE FROM results WHERE rowid <= (SELECT MAX(rowid) FROM results) - ?',
+                                                    (self.max_disk_entries,)).rowcount
+            self._db.commit()
+
+    def _check_disk_fingerprint(self, fingerprint):
+        # the disk tier is checked separately, it may hold results from before a restart
+        if fingerprint == self._disk_fingerprint:
+            return
+        self.disk_invalidations += self._db.execute('DELETE FROM results WHERE fingerprint != ?', (fingerprint,)).rowcount
+        self._db.commit()
+        self._disk_fingerprint = fingerprint
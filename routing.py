@@ -0,0 +1,78 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Routes a top level classification to the second level classifiers which refine it.  The routes are declared as a
+# list of (pattern, classifiers) pairs, where a pattern is an exact class name, a prefix ending in '*', or '*' alone as
+# the fallback for classes matching nothing else.  They are checked once when the router is built and every class seen
+# is resolved once, after which routing is a dictionary lookup.  Confidence thresholds decide how deep to go: no second
+# level at all when the top level is hopeless or already conclusive, and both candidate branches when the top two
+# classes are too close to call.
+
+FALLBACK = '*'
+
+class Router(object):
+    def __init__(self, routes, known_classifiers, hopeless=0.0, conclusive=None, margin=0.0):
+        self.hopeless = hopeless
+        self.conclusive = conclusive
+        self.margin = margin
+        self._exact = {}
+        self._prefixes = []
+        self._fallback = []
+        for pattern, classifiers in routes:
+            unknown = [name for name in classifiers if name not in known_classifiers]
+            if unknown:
+                raise ValueError('Route %s names unknown classifiers: %s' % (pattern, ', '.join(unknown)))
+            if pattern == FALLBACK:
+                self._fallback = list(classifiers)
+            elif pattern.endswith('*'):
+                self._prefixes.append((pattern[:-1], list(classifiers)))
+            else:
+                self._exact[pattern] = list(classifiers)
+        # the longest, most specific prefix wins
+        self._prefixes.sort(key=lambda prefix: -len(prefix[0]))
+        self._resolved = {}
+        # changes with the routes or thresholds, so results cached under another routing are not served
+        self.fingerprint = repr((sorted(self._exact.items()), self._prefixes, self._fallback, hopeless, conclusive, margin))
+
+    def branch(self, class_name):
+        # the second level classifiers for a top level class, all of them run concurrently
+        classifiers = self._resolved.get(class_name)
+        if classifiers is None:
+            classifiers = self._exact.get(class_name)
+            if classifiers is None:
+                classifiers = next((branch for prefix, branch in self._prefixes if class_name.startswith(prefix)), self._fallback)
+            self._resolved[class_name] = classifiers
+        return classifiers
+
+    def route(self, top):
+        # candidate (confidence, class, classifiers) branches for a top level result, best first, empty when the
+        # second level is skipped.  Only a top class with a route of its own is compared with the runner up: without one
+        # it has nothing to agree with and would lose to any runner up branch, however poorly that branch agreed
+        if top['confidence_1'] < self.hopeless or (self.conclusive is not None and top['confidence_1'] >= self.conclusive):
+            return []
+        branch = self.branch(top['class_1'])
+        if not branch:
+            return []
+        candidates = [(top['confidence_1'], top['class_1'], branch)]
+        runner_up = self.branch(top['class_2'])
+        if top['confidence_1'] - top['confidence_2'] < self.margin and runner_up and runner_up != branch:
+            candidates.append((top['confidence_2'], top['class_2'], runner_up))
+        return candidates
+
+def choose(candidates, outputs):
+    # the candidate whose top level confidence and mean second level confidence agree the most, outputs holds the
+    # top two result of every classifier which answered
+    def combined(candidate):
+        confidence, _, classifiers = candidate
+        answered = [outputs[name]['confidence_1'] for name in classifiers if name in outputs]
+        return confidence * sum(answered) / len(answered) if answered else 0.0
+    return max(candidates, key=combined) if candidates else None
@@ -10,10 +10,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import gzip
 import json
 import os
-import requests
-import datetime
+import io
+import csv
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import wraps
 
 # handle no _config.py file added
 try:
@@ -21,10 +27,18 @@ try:
 except:
     pass
 
-from flask import Flask, render_template, request
+from flask import Flask, Response, render_template, request, stream_with_context
 from watson_developer_cloud import NaturalLanguageClassifierV1
 from flask_table import Table, Col
-from lxml import html
+import metrics
+from call_guard import CircuitOpenError, GuardedCaller
+from local_classifier import LocalClassifierService
+from alerts import AlertDispatcher
+from kohls_fetcher import KohlsPageFetcher
+from prepare_data import prepare_all
+from registry_store import RegistryStore
+from result_cache import ResultCache, classifier_fingerprint
+from routing import Router, choose
 
 app = Flask(__name__)
 
@@ -38,6 +52,23 @@ REQ_CLASSIFIERS = [['Product_description_Top_Level', 'product_descriptions_top_l
                    ['Product_description_Apparel', 'product_descriptions_apparel.csv']
                    ]
 
+# Second level classifiers refining each top level class, matched on the exact class or a prefix ending in '*'.  All
+# classifiers of a branch run concurrently, '*' alone catches classes matching nothing else
+ROUTES = [
+    # clothing points to the target gender and the product specifics classifiers
+    ('Apparel-Clothing', ['Product_description_Gender', 'Product_description_Clothing']),
+    # fashion accessories, which are tougher to determine target gender
+    ('Apparel-Accessories', ['Product_description_Apparel']),
+    # electronic and automotive products
+    ('Electronics-*', ['Product_description_Electronics']),
+    # health, beauty and fitness products
+    ('Health_*', ['Product_description_Health']),
+    # home goods
+    ('Home-*', ['Product_description_Home']),
+    # anything else is reported at the top level only
+    ('*', []),
+]
+
 
 VCAP_SERVICES = os.getenv("VCAP_SERVICES")
 if VCAP_SERVICES is not None:
@@ -67,114 +98,298 @@ else:
         ALERT_USERNAME = _config.alert_user
         ALERT_PASSWORD = _config.alert_password
     except:
-    # handling for hardcoding credentials
-        NLC_USERNAME = ""
-        NLC_PASSWORD = "" 
+    # handling for hardcoding credentials, or passing them through the environment
+        NLC_USERNAME = os.getenv('NLC_USERNAME', '')
+        NLC_PASSWORD = os.getenv('NLC_PASSWORD', '')
         # OPTIONAL APP NOTIFICATIONS FROM IBM ALERT NOTIFICATION
         ALERT_USERNAME = ''
         ALERT_PASSWORD = ''
 # location to data is now the same for both local and Bluemix deployment
 data_folder = os.path.join(cur_path, 'data')       
+# validated, de-duplicated copies of the training data which are actually uploaded
+PREPARED_FOLDER = os.getenv('PREPARED_FOLDER', os.path.join(data_folder, 'prepared'))
 
-# initialize variables
-CLASSIFIER_READY = None
-CLASSIFIER_STATUS = None
-ALL_CLASSIFIERS = None
-NLC_SERVICE = None
-    
-@app.route('/')
-def Welcome():
-    # call global variables
-    global CLASSIFIER_READY
-    global CLASSIFIER_STATUS
-    global ALL_CLASSIFIERS
-    global NLC_SERVICE
-    
+# base url of the NLC service, override to point at a local stand in such as benchmark/stub_nlc.py
+NLC_URL = os.getenv('NLC_URL', 'https://gateway.watsonplatform.net/natural-language-classifier/api')
+
+# seconds to wait for each response from the NLC service, connecting gets a few seconds on top
+NLC_TIMEOUT = float(os.getenv('NLC_TIMEOUT', '10'))
+
+# service behind _classify: 'watson' for the remote NLC service, 'local' for the in-process classifiers trained from data_folder
+NLC_BACKEND = os.getenv('NLC_BACKEND', 'watson').lower()
+
+# seconds between classifier status polls, quick while anything is training and backing off to the slow rate once everything is available
+POLL_FAST = int(os.getenv('CLASSIFIER_POLL_FAST', '15'))
+POLL_SLOW = int(os.getenv('CLASSIFIER_POLL_SLOW', '600'))
+
+# file shared by the workers of a pre-fork server (see gunicorn.conf.py), one of them polls the NLC service and the rest
+# read its results.  Not used with the local backend, whose classifier ids only exist in the process which trained them
+REGISTRY_STORE = os.getenv('REGISTRY_STORE') or None
+
+# bounded worker pool shared by all bulk classification uploads
+BATCH_WORKERS = int(os.getenv('BATCH_WORKERS', '8'))
+BATCH_POOL = ThreadPoolExecutor(max_workers=BATCH_WORKERS)
+
+# cached classification results, RESULT_CACHE_PATH adds an SQLite tier which survives restarts
+RESULT_CACHE = ResultCache(max_entries=int(os.getenv('RESULT_CACHE_SIZE', '10000')), path=os.getenv('RESULT_CACHE_PATH') or None,
+                           max_disk_entries=int(os.getenv('RESULT_CACHE_DISK_SIZE', '100000')))
+
+# how deep the cascade goes, see evaluate_cascade.py for picking these.  No second level below ROUTE_HOPELESS top level
+# confidence or at and above ROUTE_CONCLUSIVE, and the branches of both top level candidates when their confidences are
+# within ROUTE_FAN_OUT_MARGIN, keeping whichever agrees best.  The defaults always follow the top level choice
+ROUTER = Router(ROUTES, [name for name, _ in REQ_CLASSIFIERS], hopeless=float(os.getenv('ROUTE_HOPELESS', '0')),
+                conclusive=float(os.getenv('ROUTE_CONCLUSIVE')) if os.getenv('ROUTE_CONCLUSIVE') else None,
+                margin=float(os.getenv('ROUTE_FAN_OUT_MARGIN', '0')))
+
+# pool for the second level classifier calls of the cascade, which are issued concurrently
+CASCADE_POOL = ThreadPoolExecutor(max_workers=int(os.getenv('CASCADE_WORKERS', '16')))
+# start the most likely second level classifiers at the same time as the top level call, discarding them if the routing disagrees
+SPECULATIVE_CASCADE = os.getenv('SPECULATIVE_CASCADE', '').lower() in ['1', 'true', 'yes']
+# how often each set of second level classifiers has been routed to, drives the speculative guess
+BRANCH_COUNTS = Counter()
+BRANCH_LOCK = threading.Lock()
+
+# identical in-flight classifier calls are shared, each classifier gets a bounded number of concurrent calls and a
+# circuit breaker.  A second level classifier whose breaker is open is skipped and the cascade stops at the top level
+CLASSIFIER_CALLS = GuardedCaller(max_concurrent=int(os.getenv('CLASSIFIER_MAX_CONCURRENT', '16')),
+                                 queue_timeout=float(os.getenv('CLASSIFIER_QUEUE_TIMEOUT', '5')),
+                                 failure_threshold=int(os.getenv('BREAKER_FAILURES', '5')),
+                                 reset_seconds=float(os.getenv('BREAKER_RESET', '30')))
+
+# shared, connection pooled fetcher for Kohl's product pages
+PAGE_FETCHER = KohlsPageFetcher(timeout=(3.05, float(os.getenv('KOHLS_TIMEOUT', '10'))), retries=int(os.getenv('KOHLS_RETRIES', '2')),
+                                base_url=os.getenv('KOHLS_BASE_URL') or None)
+
+# most items accepted in one JSON API request, and the smallest JSON response worth gzipping
+API_MAX_ITEMS = int(os.getenv('API_MAX_ITEMS', '100'))
+GZIP_MIN_BYTES = 1024
+
+# OPTIONAL APP NOTIFICATIONS FROM IBM ALERT NOTIFICATION, repeats within ALERT_WINDOW seconds are sent as one alert
+ALERTS = AlertDispatcher(ALERT_USERNAME, ALERT_PASSWORD, window=float(os.getenv('ALERT_WINDOW', '30')))
+
+# latency and call count instrumentation, exposed in Prometheus format at /metrics.  Under a pre-fork server each worker
+# shares its numbers through METRICS_DIR (see gunicorn.conf.py), so any worker's /metrics covers all of them
+METRICS_DIR = os.getenv('METRICS_DIR') or None
+METRICS = metrics.MetricsRegistry()
+STAGE_SECONDS = METRICS.histogram('nlc_stage_seconds', 'Time spent in each stage of handling a classification', ['stage'])
+CLASSIFIER_SECONDS = METRICS.histogram('nlc_classifier_call_seconds', 'Latency of each call to a classifier', ['classifier'])
+CLASSIFIER_ERRORS = METRICS.counter('nlc_classifier_call_errors_total', 'Failed calls to a classifier', ['classifier'])
+REQUESTS_IN_FLIGHT = METRICS.gauge('nlc_requests_in_flight', 'Requests currently being handled', ['endpoint'])
+REQUESTS_TOTAL = METRICS.counter('nlc_requests_total', 'Requests handled', ['endpoint', 'status'])
+CASCADE_FALLBACKS = METRICS.counter('nlc_cascade_fallbacks_total', 'Second level classifications skipped because the classifier circuit was open', ['classifier'])
+REMOTE_CALLS = METRICS.histogram('nlc_remote_calls_per_request', 'NLC and Kohls.com calls made for each request', ['endpoint'], buckets=(0, 1, 2, 3, 4, 5, 6, 8))
+# clients opt in to a Server-Timing response header by sending this request header
+TIMING_HEADER = 'X-Request-Timing'
+
+SCROLL_SCRIPT = '<script src="static/scripts/bottom_scroll.js" language="javascript" type="text/javascript"></script>'
+TRAINING_ICON = '<img id="training_icon" src="static/images/ibm-watson.gif" alt=" " class="center"/>'
+
+class ClassifierRegistry(object):
+    # single shared NLC client plus the id/status of every classifier in REQ_CLASSIFIERS.  A background poller keeps the
+    # state fresh so request handlers only ever read from it and never make outbound calls themselves.  With a store,
+    # only the process holding its lock polls and the others follow the state it publishes
+    def __init__(self, poll_fast=POLL_FAST, poll_slow=POLL_SLOW, store=None):
+        self.poll_fast = poll_fast
+        self.poll_slow = poll_slow
+        self.store = store
+        self.owner = store is None
+        self.service = None
+        self.last_refresh = None
+        # (classifiers, status, ready) is swapped in as one tuple so readers never see a half updated state
+        self._state = ({}, 'initializing', False)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    @property
+    def classifiers(self):
+        return self.snapshot()[0]
+
+    @property
+    def status(self):
+        return self.snapshot()[1]
+
+    @property
+    def ready(self):
+        return self.snapshot()[2]
+
+    def snapshot(self):
+        if not self.owner:
+            self._load()
+        return self._state
+
+    def start(self):
+        # idempotent, safe to call from every request handler
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                # followers classify with their own client as soon as the published state is ready
+                self._ensure_service()
+                self._thread = threading.Thread(target=self._poll_loop, name='classifier-registry')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def refresh_soon(self):
+        # cut the current wait short, e.g. after a classify call failed on a stale id
+        self._wake.set()
+
+    def refresh(self):
+        self._ensure_service()
+        if not self.service:
+            self._state = ({}, 'unconfigured', False)
+        else:
+            # begin training any instances not initiated and store the UUID/status of each
+            with _timed_stage('create_classifier'):
+                self._state = _init_classifiers(self.service, self._state[0])
+        self.last_refresh = time.time()
+        if self.store is not None:
+            self.store.write(self._state)
+        return self._state
+
+    def warm_up(self):
+        # run once before a pre-fork server starts its workers, so they begin with a discovered registry.  The lock is
+        # given up again afterwards and one of the workers takes over the polling
+        if self.store is not None and not self.store.try_lock():
+            # another server already owns the store
+            self._load()
+            return self._state
+        try:
+            return self.refresh()
+        finally:
+            if self.store is not None:
+                self.store.release()
+                self.owner = False
+
+    def _ensure_service(self):
+        if self.service is None:
+            # initiate NLC service, shared by every request
+            self.service = _nlc_backend()
+
+    def _load(self):
+        # pick up whatever the owning process last published
+        loaded = self.store.read()
+        if loaded is not None:
+            self._state, self.last_refresh = loaded
+
+    def _poll_loop(self):
+        interval = self.poll_fast
+        while True:
+            if not self.owner and self.store.try_lock():
+                # the previous owner exited, or nobody polled yet
+                self.owner = True
+            if not self.owner:
+                # cheap, the owner does the polling
+                self._load()
+                self._wake.wait(self.poll_fast)
+                self._wake.clear()
+                continue
+            try:
+                _, status, _ = self.refresh()
+            except Exception as details:
+                # keep serving the last known classifiers, just retry sooner
+                _error_alerts(details, 'classifier_registry', 'Warning')
+                status = 'error'
+            if status == 'unconfigured':
+                return
+            if status == 'available':
+                # everything is trained, back off towards the slow poll rate
+                interval = min(interval * 2, self.poll_slow)
+            else:
+                interval = self.poll_fast
+            self._wake.wait(interval)
+            self._wake.clear()
+
+def _nlc_backend():
+    # the local backend needs no credentials, it trains its own classifiers from the bundled CSVs
+    if NLC_BACKEND == 'local':
+        return LocalClassifierService()
     try:
-        # initiate NLC service
-        NLC_SERVICE = NaturalLanguageClassifierV1(
+        nlc_service = NaturalLanguageClassifierV1(
+        url=NLC_URL,
         username=NLC_USERNAME,
-        password=NLC_PASSWORD      
+        password=NLC_PASSWORD
         )
-    except:
+        # no call can hold a worker thread indefinitely when the service slows down
+        nlc_service.set_http_config({'timeout': (3.05, NLC_TIMEOUT)})
+        return nlc_service
+    except Exception:
         # catch authentication failures and raise warning message
-        NLC_SERVICE = False
-        
-    if NLC_SERVICE:
-        try:
-            # If the credentials are authenticated, begin training any instances not initiated and store the UUID/status of each
-            ALL_CLASSIFIERS, CLASSIFIER_STATUS, CLASSIFIER_READY = _init_classifiers()
-            
-            # easier to check no failures than all successes
-            if len([data['status'] for data in ALL_CLASSIFIERS.values() if data['status'] in ['Non Existent', 'Training', 'Failed', 'Unavailable']]) == 0:
-                # CLASSIFIER_STATUS used both for in app error messages and also can be incorporated into flask_table to trigger HTML formatting
-                # by passing the value to flask_table class as an id
-                CLASSIFIER_STATUS = 'available'
-                CLASSIFIER_READY = True
-            elif 'Training' in [data['status'] for data in ALL_CLASSIFIERS.values()]:
-                CLASSIFIER_STATUS = 'training'
-                CLASSIFIER_READY = False
-            else:
-                CLASSIFIER_STATUS = 'unavailable'
-                CLASSIFIER_READY = False
-              
-            # retrieve classifier information
-            _CLASSIFIER = [{'_name':_name,'_id':data['id'], '_status':data['status']} for _name, data in ALL_CLASSIFIERS.items()]
-            classifier_info = ConfigTable(_CLASSIFIER)
-            # update the UI, but only the classifier info box
-            if CLASSIFIER_READY:
-                # fill in the text boxes internally so they don't appear as empty when not used
-                return render_template('index.html', classifier_info=classifier_info)
-            elif CLASSIFIER_STATUS == 'training':
-                # Return status on any classifier instances which are still training
-                return render_template('index.html', classifier_info=classifier_info, error_line = 'Classifier is currently %s.' % (CLASSIFIER_STATUS), training_icon = '<img id="training_icon" src="static/images/ibm-watson.gif" alt=" " class="center"/>', scroll_script = '<script src="static/scripts/bottom_scroll.js" language="javascript" type="text/javascript"></script>')
-            else:
-                # Return status on any classifier instances which are experiencing issues
-                return render_template('index.html', classifier_info=classifier_info, error_line = 'Classifier is currently %s.' % (CLASSIFIER_STATUS))
-        except Exception as details:
-            # send service failure alert            
-            _error_alerts(details, Flask(__name__), 'Fatal')
-            # return error page
-            return render_template('index.html', classifier_info=classifier_info, error_line = 'Unexpected error encountered')
-    else:
+        return False
+
+REGISTRY = ClassifierRegistry(store=RegistryStore(REGISTRY_STORE) if REGISTRY_STORE and NLC_BACKEND != 'local' else None)
+
+def _instrumented(endpoint):
+    # in-flight gauge, total latency, remote call count and the opt-in Server-Timing header for a request handler
+    def decorator(handler):
+        @wraps(handler)
+        def wrapper(*args, **kwargs):
+            REQUESTS_IN_FLIGHT.inc(endpoint=endpoint)
+            record = metrics.start_request()
+            status = 500
+            try:
+                with _timed_stage(endpoint):
+                    response = app.make_response(handler(*args, **kwargs))
+                status = response.status_code
+                if request.headers.get(TIMING_HEADER):
+                    response.headers['Server-Timing'] = metrics.server_timing(record)
+                return response
+            finally:
+                REMOTE_CALLS.observe(record['remote_calls'], endpoint=endpoint)
+                REQUESTS_TOTAL.inc(endpoint=endpoint, status=status)
+                REQUESTS_IN_FLIGHT.dec(endpoint=endpoint)
+                metrics.end_request()
+        return wrapper
+    return decorator
+
+def _timed_stage(stage):
+    # time a block both in the stage histogram and in the current request's Server-Timing breakdown
+    return metrics.timed(STAGE_SECONDS, record_as=stage, stage=stage)
+
+def _render_index(**context):
+    # render_template is timed on its own, the flask_table tables are rendered as part of it
+    with _timed_stage('render_template'):
+        return render_template('index.html', **context)
+
+@app.route('/')
+@_instrumented('welcome')
+def Welcome():
+    # the registry is refreshed in the background, rendering the page makes no calls to the NLC service
+    REGISTRY.start()
+    all_classifiers, classifier_status, classifier_ready = REGISTRY.snapshot()
+
+    if classifier_status == 'unconfigured':
         # Return only a message that the NLC access has not been provisioned.  Adding credentials to a _config.py file, 
         # hardcoding them in to this script or launching this app through IBM Bluemix will all automate the training process
-        return render_template('index.html', error_line="Please add a _config.py file with your NLC credentials if running locally. ", scroll_script = '<script src="static/scripts/bottom_scroll.js" language="javascript" type="text/javascript"></script>')
+        return _render_index(error_line="Please add a _config.py file with your NLC credentials if running locally. ", scroll_script = SCROLL_SCRIPT)
+
+    # retrieve classifier information
+    classifier_info = _config_table(all_classifiers)
+    # update the UI, but only the classifier info box
+    if classifier_ready:
+        # fill in the text boxes internally so they don't appear as empty when not used
+        return _render_index(classifier_info=classifier_info)
+    elif classifier_status in ['training', 'initializing']:
+        # Return status on any classifier instances which are still training
+        return _render_index(classifier_info=classifier_info, error_line = 'Classifier is currently %s.' % (classifier_status), training_icon = TRAINING_ICON, scroll_script = SCROLL_SCRIPT)
+    else:
+        # Return status on any classifier instances which are experiencing issues
+        return _render_index(classifier_info=classifier_info, error_line = 'Classifier is currently %s.' % (classifier_status))
         
 
 @app.route('/classify_text', methods=['GET', 'POST'])
+@_instrumented('classify_text')
 def classify_text():
-    # call global variables
-    global CLASSIFIER_READY
-    global CLASSIFIER_STATUS
-    global ALL_CLASSIFIERS
-    global NLC_SERVICE
-    
+    REGISTRY.start()
+    all_classifiers, classifier_status, classifier_ready = REGISTRY.snapshot()
+
     # get the text from the UI
     input_text = request.form['classifierinput_text']
 
     # get info on our classifiers and format their statuses to HTML table
-    try:
-        # retrieve classifier information
-        _CLASSIFIER = [{'_name':_name,'_id':data['id'], '_status':data['status']} for _name, data in ALL_CLASSIFIERS.items()]
-        classifier_info = ConfigTable(_CLASSIFIER)
-    # catch error in retrieving classifier information
-    except Exception as details:
-        # send service warning alert
-        _error_alerts(details, 'classify_text', 'Warning')
-        try:
-            # rerun retrieval of classifier information
-            ALL_CLASSIFIERS, CLASSIFIER_STATUS, CLASSIFIER_READY = _init_classifiers()
-            _CLASSIFIER = [{'_name':_name,'_id':data['id'], '_status':data['status']} for _name, data in ALL_CLASSIFIERS.items()]
-            classifier_info = ConfigTable(_CLASSIFIER)
-        # catch continued error in retreiving classifier information
-        except Exception as details_2:
-            # send service failure alert
-            _error_alerts(details_2, 'classify_text', 'Fatal')
-            # return error page
-            return render_template('index.html', classifier_info=classifier_info, error_line = 'Unexpected error encountered retrieving NLC instances, please try reloading the home page.', scroll_script = '<script src="static/scripts/bottom_scroll.js" language="javascript" type="text/javascript"></script>')
+    classifier_info = _config_table(all_classifiers)
     
-    if CLASSIFIER_READY:
+    if classifier_ready:
         # check for valid product description
         try:
             if input_text != '': 
@@ -188,46 +403,30 @@ def classify_text():
                 all_results = ResultsTable(full_output)
                 
                 # fill in the text boxes internally so they don't appear as empty when not used
-                return render_template('index.html', classifier_info=classifier_info, classifier_input = '<textarea rows="5" cols="126"> %s </textarea>' % (input_text), all_results = all_results, error_line = concat_output, scroll_script = '<script src="static/scripts/bottom_scroll.js" language="javascript" type="text/javascript"></script>')
+                return _render_index(classifier_info=classifier_info, classifier_input = '<textarea rows="5" cols="126"> %s </textarea>' % (input_text), all_results = all_results, error_line = concat_output, scroll_script = SCROLL_SCRIPT)
             else:
                 # return a reminder that this can only handle product pages from Kohl's if an invalid url is passed
-                return render_template('index.html', classifier_info=classifier_info, error_line = 'Invalid Url.  Please provide a product page from Kohls.com, or manually add the product description above.', scroll_script = '<script src="static/scripts/bottom_scroll.js" language="javascript" type="text/javascript"></script>')
+                return _render_index(classifier_info=classifier_info, error_line = 'Invalid Url.  Please provide a product page from Kohls.com, or manually add the product description above.', scroll_script = SCROLL_SCRIPT)
         except Exception as details:
-            # send service failure alert
+            # send service failure alert and have the registry re-check the classifiers
             _error_alerts(details, 'classify_text', 'Fatal')
+            REGISTRY.refresh_soon()
             # return error page
-            return render_template('index.html', classifier_info=classifier_info, error_line = 'Unexpected error encountered', scroll_script = '<script src="static/scripts/bottom_scroll.js" language="javascript" type="text/javascript"></script>')
+            return _render_index(classifier_info=classifier_info, error_line = 'Unexpected error encountered', scroll_script = SCROLL_SCRIPT)
     else:
         # return only classifier information in event of failure
-        return render_template('index.html', classifier_info=classifier_info, classifier_input = input_text, error_line = 'Classifier is currently %s.' % (CLASSIFIER_STATUS), scroll_script = '<script src="static/scripts/bottom_scroll.js" language="javascript" type="text/javascript"></script>')
+        return _render_index(classifier_info=classifier_info, classifier_input = input_text, error_line = 'Classifier is currently %s.' % (classifier_status), scroll_script = SCROLL_SCRIPT)
 
 
         
 @app.route('/classify_url', methods=['GET', 'POST'])
+@_instrumented('classify_url')
 def classify_url(): 
-    global CLASSIFIER_READY
-    global CLASSIFIER_STATUS
-    global ALL_CLASSIFIERS
-    global NLC_SERVICE
-    
+    REGISTRY.start()
+    all_classifiers, classifier_status, classifier_ready = REGISTRY.snapshot()
+
     # get info on our classifiers and format their statuses to HTML table
-    try:
-        _CLASSIFIER = [{'_name':_name,'_id':data['id'], '_status':data['status']} for _name, data in ALL_CLASSIFIERS.items()]
-        classifier_info = ConfigTable(_CLASSIFIER)
-    except Exception as details:
-        # send service warning alert
-        _error_alerts(details, 'classify_url', 'Warning')
-        try:
-            # rerun retrieval of classifier information
-            ALL_CLASSIFIERS, CLASSIFIER_STATUS, CLASSIFIER_READY = _init_classifiers()
-            _CLASSIFIER = [{'_name':_name,'_id':data['id'], '_status':data['status']} for _name, data in ALL_CLASSIFIERS.items()]
-            classifier_info = ConfigTable(_CLASSIFIER)
-        # catch continued error in retreiving classifier information
-        except Exception as details_2:
-            # send service failure alert
-            _error_alerts(details_2, 'classify_url', 'Fatal')
-            # return error page
-            return render_template('index.html', classifier_info=classifier_info, error_line = 'Unexpected error encountered retrieving NLC instances, please try reloading the home page.', scroll_script = '<script src="static/scripts/bottom_scroll.js" language="javascript" type="text/javascript"></script>')
+    classifier_info = _config_table(all_classifiers)
     
     # get the text from the UI    
     input_url = request.form['classifierinput_url']
@@ -239,9 +438,9 @@ def classify_url():
         # send service failure alert
         _error_alerts(details, 'get_url_text', 'Fatal')
         # return error page
-        return render_template('index.html', classifier_info=classifier_info, error_line = 'Invalid Url.  Please provide a product page from Kohls.com, or manually add the product description above.', scroll_script = '<script src="static/scripts/bottom_scroll.js" language="javascript" type="text/javascript"></script>')
+        return _render_index(classifier_info=classifier_info, error_line = 'Invalid Url.  Please provide a product page from Kohls.com, or manually add the product description above.', scroll_script = SCROLL_SCRIPT)
         
-    if CLASSIFIER_READY:
+    if classifier_ready:
         # check for valid product description
         try:
             if input_text:
@@ -255,19 +454,131 @@ def classify_url():
                 all_results = ResultsTable(full_output)
                 
                 # fill in the text boxes internally so they don't appear as empty when not used
-                return render_template('index.html', classifier_info=classifier_info, classifier_input = '<textarea rows="5" cols="126"> %s </textarea>' % (input_text), all_results = all_results, error_line = concat_output, scroll_script = '<script src="static/scripts/bottom_scroll.js" language="javascript" type="text/javascript"></script>')
+                return _render_index(classifier_info=classifier_info, classifier_input = '<textarea rows="5" cols="126"> %s </textarea>' % (input_text), all_results = all_results, error_line = concat_output, scroll_script = SCROLL_SCRIPT)
             else:
                 # return a reminder that this can only handle product pages from Kohl's if an invalid url is passed
-                return render_template('index.html', classifier_info=classifier_info, error_line = 'Invalid Url.  Please provide a product page from Kohls.com, or manually add the product description above.', scroll_script = '<script src="static/scripts/bottom_scroll.js" language="javascript" type="text/javascript"></script>')
+                return _render_index(classifier_info=classifier_info, error_line = 'Invalid Url.  Please provide a product page from Kohls.com, or manually add the product description above.', scroll_script = SCROLL_SCRIPT)
         except Exception as details:
-            # send service failure alert
+            # send service failure alert and have the registry re-check the classifiers
             _error_alerts(details, 'classify_url', 'Fatal')
+            REGISTRY.refresh_soon()
             # return error page
-            return render_template('index.html', classifier_info=classifier_info, error_line = 'Unexpected error encountered', scroll_script = '<script src="static/scripts/bottom_scroll.js" language="javascript" type="text/javascript"></script>')
+            return _render_index(classifier_info=classifier_info, error_line = 'Unexpected error encountered', scroll_script = SCROLL_SCRIPT)
     else:
         # return only classifier information in event of failure
-        return render_template('index.html', classifier_info=classifier_info, classifier_input = input_text, error_line = 'Classifier is currently %s.' % (CLASSIFIER_STATUS), scroll_script = '<script src="static/scripts/bottom_scroll.js" language="javascript" type="text/javascript"></script>')
-  
+        return _render_index(classifier_info=classifier_info, classifier_input = input_text, error_line = 'Classifier is currently %s.' % (classifier_status), scroll_script = SCROLL_SCRIPT)
+
+@app.route('/classify_batch', methods=['POST'])
+def classify_batch():
+    # bulk classification of a JSONL or CSV upload, results are streamed back as NDJSON while the batch is still running
+    REGISTRY.start()
+    if not REGISTRY.ready:
+        return Response(json.dumps({'error': 'Classifier is currently %s.' % (REGISTRY.status)}) + '\n', status=503, mimetype='application/x-ndjson')
+
+    # accept either a multipart file upload or the raw request body
+    upload = request.files.get('file')
+    if upload is not None:
+        stream = io.TextIOWrapper(upload.stream, encoding='utf-8', errors='replace')
+        filename = upload.filename or ''
+    else:
+        stream = io.TextIOWrapper(request.stream, encoding='utf-8', errors='replace')
+        filename = ''
+    batch_format = _batch_format(request.args.get('format'), filename, request.mimetype)
+    if batch_format is None:
+        return Response(json.dumps({'error': 'Unknown batch format, use ?format=jsonl or ?format=csv'}) + '\n', status=400, mimetype='application/x-ndjson')
+
+    return Response(stream_with_context(_run_batch(_read_batch_rows(stream, batch_format))), mimetype='application/x-ndjson')
+
+@app.route('/api/v1/classify', methods=['POST'])
+@_instrumented('api_classify')
+def api_classify():
+    # JSON in, JSON out: no flask_table or template work, just the classification
+    return _api_handler('text', _api_classify_text)
+
+@app.route('/api/v1/classify_url', methods=['POST'])
+@_instrumented('api_classify_url')
+def api_classify_url():
+    return _api_handler('url', _api_classify_url)
+
+def _api_handler(field, classify_item):
+    # accepts a single item or an array of items, each either a bare string or an object with the field and an optional id
+    REGISTRY.start()
+    if not REGISTRY.ready:
+        return _json_response({'error': 'Classifier is currently %s.' % (REGISTRY.status)}, 503)
+    payload = request.get_json(silent=True)
+    if payload is None:
+        return _json_response({'error': 'Expected a JSON body'}, 400)
+    single = not isinstance(payload, list)
+    items = [payload] if single else payload
+    if len(items) > API_MAX_ITEMS:
+        return _json_response({'error': 'At most %d items per request' % (API_MAX_ITEMS)}, 400)
+    items = [item if isinstance(item, dict) else {field: item} for item in items]
+    if single:
+        results = [classify_item(items[0])]
+    else:
+        # independent items are classified concurrently, results keep the request order
+        results = list(BATCH_POOL.map(metrics.in_context(classify_item), items))
+    if single:
+        return _json_response(results[0], 200 if 'error' not in results[0] else 422)
+    return _json_response({'results': results})
+
+def _api_result(item, input_text):
+    return _api_format(item, _classify(input_text))
+
+def _api_format(item, full_output):
+    # response for one classified item, shared with async_app.py
+    result = {'path': '-'.join([_capitalize(i['class_1']) for i in full_output]),
+              'levels': [_capitalize(i['class_1']) for i in full_output],
+              'confidences': [i['confidence_1'] for i in full_output],
+              'hierarchy': full_output}
+    if 'id' in item:
+        result['id'] = item['id']
+    return result
+
+def _api_classify_text(item):
+    text = item.get('text')
+    if not isinstance(text, str) or not text.strip():
+        return _api_error(item, 'No text to classify')
+    try:
+        return _api_result(item, text)
+    except Exception as details:
+        _error_alerts(details, 'api_classify', 'Fatal')
+        return _api_error(item, 'Unexpected error encountered')
+
+def _api_classify_url(item):
+    url = item.get('url')
+    try:
+        input_text = _get_Kohls_url_info(url) if isinstance(url, str) else False
+    except Exception as details:
+        _error_alerts(details, 'get_url_text', 'Fatal')
+        input_text = False
+    if not input_text:
+        return _api_error(item, 'Invalid Url.  Please provide a product page from Kohls.com.')
+    try:
+        result = _api_result(item, input_text)
+    except Exception as details:
+        _error_alerts(details, 'api_classify_url', 'Fatal')
+        return _api_error(item, 'Unexpected error encountered')
+    result['url'] = url
+    result['text'] = input_text
+    return result
+
+def _api_error(item, message):
+    error = {'error': message}
+    if 'id' in item:
+        error['id'] = item['id']
+    return error
+
+def _json_response(body, status=200):
+    # compact JSON, gzipped when the client accepts it and it is big enough to be worth it
+    data = json.dumps(body, separators=(',', ':')).encode('utf-8')
+    response = Response(data, status=status, mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    if len(data) >= GZIP_MIN_BYTES and 'gzip' in request.accept_encodings:
+        response.set_data(gzip.compress(data, 5))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
 class ResultsTable(Table):
     # set class id and table values
     table_id = 'classes'
@@ -283,8 +594,12 @@ class ConfigTable(Table):
     _id = Col('ID') 
     _status = Col('Status') 
 
-def _init_classifiers():
-    ALL_CLASSIFIERS = _create_classifier()
+def _config_table(all_classifiers):
+    # format classifier statuses to HTML table
+    return ConfigTable([{'_name':_name,'_id':data['id'], '_status':data['status']} for _name, data in all_classifiers.items()])
+
+def _init_classifiers(nlc_service, serving=None):
+    ALL_CLASSIFIERS = _create_classifier(nlc_service, serving or {})
     # easier to check no failures than all successes
     if len([data['status'] for data in ALL_CLASSIFIERS.values() if data['status'] in ['Non Existent', 'Training', 'Failed', 'Unavailable']]) == 0:
         # CLASSIFIER_STATUS used both for in app error messages and also can be incorporated into flask_table to trigger HTML formatting
@@ -299,73 +614,338 @@ def _init_classifiers():
         CLASSIFIER_READY = False
     return ALL_CLASSIFIERS, CLASSIFIER_STATUS, CLASSIFIER_READY
 
-def _create_classifier():
+def _versioned_name(name, sha256):
+    # classifiers are named after the content hash of their prepared training data, so edited data trains a new one
+    return '%s_v%s' % (name, sha256[:12])
+
+def _create_classifier(nlc_service, serving):
+    # serving holds the classifiers published by the previous poll.  Validate, de-duplicate and hash the training data, redone only for source files which changed
+    PREPARED = prepare_all(REQ_CLASSIFIERS, data_folder, PREPARED_FOLDER)
     # fetch all classifiers associated with the NLC instance
-    result = NLC_SERVICE.list_classifiers()    
+    result = nlc_service.list_classifiers()    
     ALL_CLASSIFIERS = {}
     
     for name, DATA_SET in REQ_CLASSIFIERS:
         # initiate the dictionary storage for each instance
         ALL_CLASSIFIERS[name] = {'id':'', 'status':''}
+        prepared = PREPARED[name]
+        if 'error' in prepared:
+            # never upload data which could only fail after a slow remote training run
+            ALL_CLASSIFIERS[name]['status'] = 'Failed'
+            continue
+        current_name = _versioned_name(name, prepared['sha256'])
+        # every version of this classifier, newest first.  The plain name is what was trained before versioning
+        versions = sorted([c for c in result['classifiers'] if c['name'] == name or c['name'].startswith(name + '_v')], key=lambda c: c.get('created', ''), reverse=True)
+        current = [c for c in versions if c['name'] == current_name]
         # find any instances which need training but havent been initiated
-        if name not in [result['classifiers'][i]['name'] for (i,x) in enumerate(result['classifiers'])]:
-            with open(os.path.join(data_folder, DATA_SET), 'rb') as training_data:
-                metadata = '{"name": "%s", "language": "en"}' % (name)
-                classifier = NLC_SERVICE.create_classifier(
+        if not current:
+            with open(prepared['path'], 'rb') as training_data:
+                metadata = '{"name": "%s", "language": "en"}' % (current_name)
+                classifier = nlc_service.create_classifier(
                     metadata=metadata,
                     training_data=training_data
                 ) 
-                # store classifier information for future handling between the different instances
-                ALL_CLASSIFIERS[name]['id'] = classifier['classifier_id'] 
-                ALL_CLASSIFIERS[name]['status'] = classifier['status'] 
+            # store classifier information for future handling between the different instances
+            ALL_CLASSIFIERS[name]['id'] = classifier['classifier_id'] 
+            ALL_CLASSIFIERS[name]['status'] = classifier['status'] 
         else:
             # store classifier information for future handling between the different instances
-            ALL_CLASSIFIERS[name]['id'] = [result['classifiers'][i]['classifier_id'] for (i,x) in enumerate(result['classifiers']) if result['classifiers'][i]['name'] == name][0]
-            ALL_CLASSIFIERS[name]['status'] = NLC_SERVICE.get_classifier(ALL_CLASSIFIERS[name]['id'])['status']                
+            ALL_CLASSIFIERS[name]['id'] = current[0]['classifier_id']
+            ALL_CLASSIFIERS[name]['status'] = nlc_service.get_classifier(ALL_CLASSIFIERS[name]['id'])['status']                
+        previous = serving.get(name, {})
+        if ALL_CLASSIFIERS[name]['status'] == 'Available':
+            # once the previous poll has published the cut over nothing serves the earlier versions any more
+            if previous.get('id') == ALL_CLASSIFIERS[name]['id']:
+                _delete_versions(nlc_service, [c for c in versions if c['classifier_id'] != ALL_CLASSIFIERS[name]['id']])
+        elif previous.get('pending') == ALL_CLASSIFIERS[name]['id'] and previous['id'] in [c['classifier_id'] for c in versions]:
+            # still training, keep the earlier version found by a previous poll rather than probing every one again
+            ALL_CLASSIFIERS[name] = dict(previous)
+        else:
+            # keep serving the newest earlier version until the retrained one is available, then the next poll cuts over
+            for version in versions:
+                if version['classifier_id'] != ALL_CLASSIFIERS[name]['id'] and nlc_service.get_classifier(version['classifier_id'])['status'] == 'Available':
+                    ALL_CLASSIFIERS[name] = {'id': version['classifier_id'], 'status': 'Available', 'pending': ALL_CLASSIFIERS[name]['id']}
+                    break
     return ALL_CLASSIFIERS
 
+def _delete_versions(nlc_service, versions):
+    # superseded versions each still count against the instance's classifier limit
+    for version in versions:
+        try:
+            nlc_service.delete_classifier(version['classifier_id'])
+        except Exception as details:
+            # retried on the next poll, which still lists it
+            _error_alerts(details, 'delete_classifier', 'Warning')
+
 def _classify(input_text):
-    # send the text to the first classifier, get high level classification which determines which other classifiers the text is passed to
-    classifier_output_0 = NLC_SERVICE.classify(ALL_CLASSIFIERS['Product_description_Top_Level']['id'], input_text)['classes'][:2]
-    classifier_output_0 = [{'class_1':classifier_output_0[0]['class_name'], 'confidence_1':classifier_output_0[0]['confidence'], 'class_2':classifier_output_0[1]['class_name'], 'confidence_2':classifier_output_0[1]['confidence']}]
-    
-    # top level classification of clothing points to this classifier specifically trained on that domain                                   
-    if classifier_output_0[0]['class_1'] == 'Apparel-Clothing':
-        # initial classification used first determine target gender                                  
-        classifier_output_1 = NLC_SERVICE.classify(ALL_CLASSIFIERS['Product_description_Gender']['id'], input_text)['classes'][:2]
-        classifier_output_1 = [{'class_1':classifier_output_1[0]['class_name'], 'confidence_1':classifier_output_1[0]['confidence'], 'class_2':classifier_output_1[1]['class_name'], 'confidence_2':classifier_output_1[1]['confidence']}]
-        # extra level of classification used first determine product specifics                                  
-        classifier_output_2 = NLC_SERVICE.classify(ALL_CLASSIFIERS['Product_description_Clothing']['id'], input_text)['classes'][:2]
-        classifier_output_2 = [{'class_1':classifier_output_2[0]['class_name'], 'confidence_1':classifier_output_2[0]['confidence'], 'class_2':classifier_output_2[1]['class_name'], 'confidence_2':classifier_output_2[1]['confidence']}]
-
-    # top level classification of fashion accessories, which are tougher to determine target gender, points to this classifier specifically trained on that domain                                   
-    elif classifier_output_0[0]['class_1'] == 'Apparel-Accessories':
-        classifier_output_1 = NLC_SERVICE.classify(ALL_CLASSIFIERS['Product_description_Apparel']['id'], input_text)['classes'][:2]
-        classifier_output_1 = [{'class_1':classifier_output_1[0]['class_name'], 'confidence_1':classifier_output_1[0]['confidence'], 'class_2':classifier_output_1[1]['class_name'], 'confidence_2':classifier_output_1[1]['confidence']}]
-        classifier_output_2 = {}
-
-    # top level classification of electronic and automotive products points to this classifier specifically trained on that domain                       
-    elif classifier_output_0[0]['class_1'].split('-')[0] == 'Electronics':
-        classifier_output_1 = NLC_SERVICE.classify(ALL_CLASSIFIERS['Product_description_Electronics']['id'], input_text)['classes'][:2]
-        classifier_output_1 = [{'class_1':classifier_output_1[0]['class_name'], 'confidence_1':classifier_output_1[0]['confidence'], 'class_2':classifier_output_1[1]['class_name'], 'confidence_2':classifier_output_1[1]['confidence']}]
-        classifier_output_2 = {}
-        
-    # top level classification of health, beauty and fitness products points to this classifier specifically trained on that domain           
-    elif classifier_output_0[0]['class_1'].split('_')[0] == 'Health':
-        classifier_output_1 = NLC_SERVICE.classify(ALL_CLASSIFIERS['Product_description_Health']['id'], input_text)['classes'][:2]
-        classifier_output_1 = [{'class_1':classifier_output_1[0]['class_name'], 'confidence_1':classifier_output_1[0]['confidence'], 'class_2':classifier_output_1[1]['class_name'], 'confidence_2':classifier_output_1[1]['confidence']}]
-        classifier_output_2 = {}
-    
-    # top level classification of home goods points to this classifier specifically trained on that domain
-    elif classifier_output_0[0]['class_1'].split('-')[0] == 'Home':
-        classifier_output_1 = NLC_SERVICE.classify(ALL_CLASSIFIERS['Product_description_Home']['id'], input_text)['classes'][:2]
-        classifier_output_1 = [{'class_1':classifier_output_1[0]['class_name'], 'confidence_1':classifier_output_1[0]['confidence'], 'class_2':classifier_output_1[1]['class_name'], 'confidence_2':classifier_output_1[1]['confidence']}]
-        classifier_output_2 = {}
-    
-    # top two choices for each instance used, along with the corresponding confidence
-    full_output = [k[0] for k in [classifier_output_0, classifier_output_1, classifier_output_2] if k != {}]    
+    # read the shared client and classifier ids once so the whole cascade uses a consistent snapshot
+    nlc_service = REGISTRY.service
+    all_classifiers = REGISTRY.classifiers
+
+    # results are keyed on the classifier ids and routing too, so a retrained classifier never serves stale answers
+    fingerprint = classifier_fingerprint(all_classifiers) + '|' + ROUTER.fingerprint
+    with _timed_stage('classify'):
+        full_output = RESULT_CACHE.get(input_text, fingerprint)
+        if full_output is None:
+            full_output, complete = _run_cascade(input_text, nlc_service, all_classifiers)
+            # a cascade cut short by an open circuit is not worth keeping
+            if complete:
+                RESULT_CACHE.put(input_text, fingerprint, full_output)
     return full_output
+
+def _top_two(nlc_response):
+    # top two choices for each instance used, along with the corresponding confidence
+    classes = nlc_response['classes'][:2]
+    return {'class_1':classes[0]['class_name'], 'confidence_1':classes[0]['confidence'], 'class_2':classes[1]['class_name'], 'confidence_2':classes[1]['confidence']}
+
+def _likely_branch():
+    # the second level classifiers most often routed to so far, used to guess ahead of the top level result
+    with BRANCH_LOCK:
+        if not BRANCH_COUNTS:
+            return []
+        return list(BRANCH_COUNTS.most_common(1)[0][0])
+
+def _call_classifier(nlc_service, all_classifiers, name, input_text):
+    # every classifier call goes through here so it is guarded, timed and counted per classifier name.  A call shared
+    # with an identical one already in flight is neither timed nor counted again
+    classifier_id = all_classifiers[name]['id']
+    def call():
+        metrics.count_remote_call()
+        try:
+            with metrics.timed(CLASSIFIER_SECONDS, record_as='nlc_' + name, classifier=name):
+                return nlc_service.classify(classifier_id, input_text)
+        except Exception:
+            CLASSIFIER_ERRORS.inc(classifier=name)
+            raise
+    return CLASSIFIER_CALLS.call(name, (classifier_id, input_text), call)
+
+def _run_cascade(input_text, nlc_service, all_classifiers):
+    submit = lambda name: metrics.submit_in_context(CASCADE_POOL, _call_classifier, nlc_service, all_classifiers, name, input_text)
+
+    # optionally start the most likely second level classifiers alongside the top level call
+    speculative = {}
+    if SPECULATIVE_CASCADE:
+        speculative = dict((name, submit(name)) for name in _likely_branch())
+
+    # send the text to the first classifier, get high level classification which determines which other classifiers the text is passed to
+    classifier_output_0 = _top_two(_call_classifier(nlc_service, all_classifiers, 'Product_description_Top_Level', input_text))
+    candidates = ROUTER.route(classifier_output_0)
+    called = _branch_classifiers(candidates)
+    if candidates:
+        with BRANCH_LOCK:
+            BRANCH_COUNTS[tuple(candidates[0][2])] += 1
+
+    # reuse any speculative call the routing agrees with, issue the rest together
+    pending = [speculative.pop(name) if name in speculative else submit(name) for name in called]
+    # discard guesses the routing disagreed with
+    for future in speculative.values():
+        future.cancel()
+    outputs = {}
+    complete = True
+    for name, future in zip(called, pending):
+        try:
+            outputs[name] = _top_two(future.result())
+        except CircuitOpenError:
+            # fall back to the top level rather than failing the whole classification
+            CASCADE_FALLBACKS.inc(classifier=name)
+            complete = False
+    return _assemble(classifier_output_0, candidates, outputs), complete
+
+def _branch_classifiers(candidates):
+    # every second level classifier of the candidate branches, each once and in order
+    called = []
+    for _, _, branch in candidates:
+        called.extend(name for name in branch if name not in called)
+    return called
+
+def _assemble(classifier_output_0, candidates, outputs):
+    # the hierarchy reported for a cascade, outputs holds the top two of every second level classifier which answered
+    chosen = candidates[0] if len(candidates) == 1 else choose(candidates, outputs)
+    if chosen is None or any(name not in outputs for name in chosen[2]):
+        # a classifier of the branch was skipped by its open circuit, the rest of it would land in the wrong levels, so
+        # stop at the top level
+        return [classifier_output_0]
+    if chosen[1] != classifier_output_0['class_1']:
+        # the runner up's branch agreed better, report it as the top level choice so the path stays consistent
+        classifier_output_0 = {'class_1': classifier_output_0['class_2'], 'confidence_1': classifier_output_0['confidence_2'],
+                               'class_2': classifier_output_0['class_1'], 'confidence_2': classifier_output_0['confidence_1']}
+    return [classifier_output_0] + [outputs[name] for name in chosen[2]]
                 
+@app.route('/cache_stats')
+def cache_stats():
+    # hit/miss/eviction counters for the classification result cache of the worker answering, /metrics has the totals
+    stats = RESULT_CACHE.stats()
+    stats['pid'] = os.getpid()
+    return Response(json.dumps(stats), mimetype='application/json')
+
+@app.route('/metrics')
+def metrics_endpoint():
+    # Prometheus text exposition of every metric above plus the cache, page fetcher and classifier states
+    return Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
+
+def _collect_state():
+    # values owned by other components, read at scrape time
+    cache = RESULT_CACHE.stats()
+    pages = PAGE_FETCHER.stats()
+    alerts = ALERTS.stats()
+    return [
+        ('nlc_result_cache_events_total', 'counter', 'Result cache lookups and evictions by outcome',
+         [({'event': event}, cache[event]) for event in ['hits', 'disk_hits', 'misses', 'evictions', 'disk_evictions', 'invalidations']]),
+        ('nlc_result_cache_entries', 'gauge', 'Entries in the in-memory result cache', [({}, cache['entries'])]),
+        ('nlc_kohls_fetch_events_total', 'counter', 'Kohls.com page fetches by outcome',
+         [({'event': event}, pages[event]) for event in ['fetches', 'not_modified', 'retries', 'failures']]),
+        ('nlc_alerts_total', 'counter', 'Error alerts by outcome, repeats within the window are coalesced',
+         [({'event': event}, alerts[event]) for event in ['queued', 'coalesced', 'sent', 'failed', 'dropped']]),
+        ('nlc_alerts_pending', 'gauge', 'Error alerts waiting to be sent', [({}, alerts['pending'])]),
+        ('nlc_classifier_available', 'gauge', 'Whether each classifier is available (1) or not (0)',
+         [({'classifier': name}, int(data['status'] == 'Available')) for name, data in sorted(REGISTRY.classifiers.items())]),
+    ]
+
+def guard_collector(calls, path):
+    # the call guard metrics of one caller, path tells the threaded guards from those async_app.py registers
+    def collect():
+        stats = calls.stats()
+        return [
+            ('nlc_classifier_call_events_total', 'counter', 'Guarded classifier calls by outcome, shared calls joined an identical one in flight',
+             [({'path': path, 'event': event}, stats[event]) for event in ['calls', 'shared', 'rejected', 'short_circuited', 'failures']]),
+            ('nlc_classifier_circuit_open', 'gauge', 'Whether each classifier circuit breaker is open (1), half open (0.5) or closed (0)',
+             [({'path': path, 'classifier': name}, {'open': 1, 'half_open': 0.5}.get(state, 0)) for name, state in sorted(stats['breakers'].items())]),
+        ]
+    return collect
+
+METRICS.add_collector(_collect_state)
+METRICS.add_collector(guard_collector(CLASSIFIER_CALLS, 'threaded'))
+
+@app.route('/fetch_stats')
+def fetch_stats():
+    # Kohl's page fetch counts of the worker answering, with fetch and parse time reported separately
+    stats = PAGE_FETCHER.stats()
+    stats['pid'] = os.getpid()
+    return Response(json.dumps(stats), mimetype='application/json')
+
+@app.route('/healthz')
+def healthz():
+    # liveness, the process is up and answering.  Never depends on the NLC service so a slow training run cannot get
+    # healthy workers restarted
+    REGISTRY.start()
+    return _json_response(_health())
+
+@app.route('/readyz')
+def readyz():
+    # readiness, every classifier is available so classify requests can succeed
+    REGISTRY.start()
+    return _json_response(*_readiness())
+
+def _health():
+    age = time.time() - REGISTRY.last_refresh if REGISTRY.last_refresh else None
+    return {'status': 'ok', 'pid': os.getpid(), 'registry_owner': REGISTRY.owner, 'registry_age_seconds': age}
+
+def _readiness():
+    # body and status code, shared with async_app.py
+    all_classifiers, classifier_status, classifier_ready = REGISTRY.snapshot()
+    body = {'ready': classifier_ready, 'status': classifier_status,
+            'classifiers': dict((name, data['status']) for name, data in all_classifiers.items())}
+    return body, 200 if classifier_ready else 503
+
+def warm_up():
+    # called once by the pre-fork server before its workers start (see gunicorn.conf.py): discover, or begin training,
+    # every classifier and publish the result, then make one call to each available classifier so a broken one shows
+    # up in the server log at startup rather than on the first request.  Returns the state and any failed classifiers
+    if REGISTRY.store is None:
+        # nothing to share, e.g. the local backend whose classifiers each worker trains for itself
+        return REGISTRY.snapshot(), []
+    all_classifiers, classifier_status, classifier_ready = REGISTRY.warm_up()
+    failed = []
+    for name, data in all_classifiers.items():
+        if data['status'] == 'Available':
+            try:
+                REGISTRY.service.classify(data['id'], name.replace('_', ' '))
+            except Exception as details:
+                failed.append((name, str(details)))
+    return (all_classifiers, classifier_status, classifier_ready), failed
+
+def _batch_format(requested, filename, mimetype):
+    # explicit query argument wins, then the file extension, then the content type
+    for hint in [requested, filename.rsplit('.', 1)[-1] if '.' in filename else None, mimetype]:
+        if not hint:
+            continue
+        hint = hint.lower()
+        if hint in ['jsonl', 'ndjson', 'json', 'application/x-ndjson', 'application/jsonl', 'application/json']:
+            return 'jsonl'
+        if hint in ['csv', 'text/csv']:
+            return 'csv'
+    return None
+
+def _read_batch_rows(stream, batch_format):
+    # yields (row number, row id, text, expected label, error) one row at a time so large uploads are never held in memory
+    if batch_format == 'csv':
+        # same shape as the training data: description, optional label
+        for row_num, row in enumerate(csv.reader(stream)):
+            if not row:
+                continue
+            yield row_num, row_num, row[0], row[1] if len(row) > 1 else None, None
+    else:
+        for row_num, line in enumerate(stream):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as details:
+                yield row_num, row_num, None, None, 'Invalid JSON: %s' % (details)
+                continue
+            if not isinstance(row, dict):
+                yield row_num, row_num, None, None, 'Each line must be a JSON object'
+                continue
+            row_id = next((row[key] for key in ['id', 'request_id', 'sku'] if key in row), row_num)
+            text = next((row[key] for key in ['text', 'description', 'body'] if row.get(key)), None)
+            yield row_num, row_id, text, row.get('label'), None if text else 'No text, description or body field'
+
+def _classify_row(row_num, row_id, text, expected):
+    # classify a single batch row, errors are reported inline rather than failing the whole batch
+    result = {'row': row_num, 'id': row_id}
+    if expected is not None:
+        result['expected'] = expected
+    try:
+        full_output = _classify(text)
+        result['path'] = '-'.join([_capitalize(i['class_1']) for i in full_output])
+        result['results'] = full_output
+    except Exception as details:
+        result['error'] = str(details)
+    return result
+
+def _run_batch(rows):
+    # keep a bounded number of rows in flight so a huge upload cannot flood the worker pool
+    max_in_flight = BATCH_WORKERS * 2
+    in_flight = set()
+    total = 0
+    errors = 0
+    for row_num, row_id, text, expected, error in rows:
+        total += 1
+        if error is not None:
+            errors += 1
+            yield json.dumps({'row': row_num, 'id': row_id, 'error': error}) + '\n'
+            continue
+        in_flight.add(BATCH_POOL.submit(_classify_row, row_num, row_id, text, expected))
+        # stream whatever has finished so far, only waiting once the bound is reached
+        if len(in_flight) >= max_in_flight:
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+        else:
+            done = set(future for future in in_flight if future.done())
+            in_flight -= done
+        for future in done:
+            result = future.result()
+            errors += 'error' in result
+            yield json.dumps(result) + '\n'
+    # drain whatever is still running once the upload has been fully read
+    while in_flight:
+        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            result = future.result()
+            errors += 'error' in result
+            yield json.dumps(result) + '\n'
+    yield json.dumps({'summary': {'rows': total, 'errors': errors}}) + '\n'
+
 def _capitalize(word):
     # formatting for a mistake in assembling the training data
     full_word = []
@@ -377,53 +957,29 @@ def _capitalize(word):
     return '-'.join(full_word)
   
 def _error_alerts(details, where, severity):
-    global ALERT_USERNAME 
-    global ALERT_PASSWORD
-    
-    # sent failure alert if service in use    
-    if ALERT_USERNAME != '' and ALERT_PASSWORD != '':
-        message =  "{   \"What\": \"%s\",  \"Where\": \"%s\",  \"Severity\": \"%s\",  \"When\": \"%s\"}"  % (details, where, severity, datetime.datetime.now())
-        requests.post("https://ans-us-south.opsmgmt.bluemix.net/api/alerts/v1", auth=(_config.alert_user, _config.alert_password), headers =  {"Content-Type": "application/json", "accept": "application/json"}, data = message)                        
+    # queued for the background dispatcher so a failing request never also waits on the alert service
+    ALERTS.send(details, where, severity)
     
 def _get_Kohls_url_info(url):
-    # parse passed url
-    
-    # check if valid product description
-    if url[8:34] == 'www.kohls.com/product/prd-':
-        # extract product_id
-        prd_id = url.split('/prd-')[1].split('/')[0]
-        raw_desc = []
-    
-        # loop to handle missed connections
-        while raw_desc == []:
-            # retrieve page info
-            pageContent=requests.get(url)
-            # convert to html
-            tree = html.fromstring(pageContent.content)
-            # parse html using xpath
-            raw_desc = tree.xpath('//*[@id="%s_productDetails"]/div/descendant::*/text()' % (prd_id))
-            # extract product description
-            desc = ' '.join([i for i in raw_desc if i not in ['PRODUCT FEATURES', '\r', '\n']])
-            while len(desc.split('  ')) > 1:
-                desc = desc.replace('  ', ' ') 
-            escapes = ''.join([chr(char) for char in range(1, 32)])
-            # check if unicode
-            if type(desc) is unicode:
-                # unicode.translate() different than string
-                desc = desc.translate({ord(c): None for c in escapes})
-                desc = desc[:1000]
-                desc = ' '.join(desc.split(' ')[:120])
-            elif type(desc) is str:
-                desc = desc.translate(None, escapes)
-                desc = desc[:1000]
-                desc = ' '.join(desc.split(' ')[:120])        
-            else:
-                desc = ''
-            return desc
-    else:
+    # parse passed url, False if it is not a product page from Kohls.com
+    page = PAGE_FETCHER.fetch(url)
+    if page is None:
         return False
+    return _page_description(page)
+
+def _page_description(page):
+    # fetch and parse are reported separately, a revalidated page skips the parse
+    metrics.count_remote_call()
+    STAGE_SECONDS.observe(page['fetch_seconds'], stage='kohls_fetch')
+    metrics.record_stage('kohls_fetch', page['fetch_seconds'])
+    if not page['cached']:
+        STAGE_SECONDS.observe(page['parse_seconds'], stage='kohls_parse')
+        metrics.record_stage('kohls_parse', page['parse_seconds'])
+    return page['description']
     
 
 port = os.getenv('PORT', '5000')
 if __name__ == "__main__":
+    # begin discovering/training classifiers before the first page view
+    REGISTRY.start()
     app.run(host='0.0.0.0', port=int(port))